@@ -0,0 +1,61 @@
+"""
+对比两次基准测试结果：python -m bench.compare base.json head.json [--fail-above 10]
+吞吐下降或 p95 上升超过 --fail-above 百分比时以非零状态退出，方便在 CI 里拦截回归。
+"""
+import argparse
+import json
+import sys
+
+
+def _change(base, head):
+    if not base or head is None:
+        return None
+    return (head - base) / base * 100
+
+
+def _fmt(value, change):
+    if value is None:
+        return "-"
+    return f"{value:.2f}" if change is None else f"{value:.2f} ({change:+.1f}%)"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base")
+    parser.add_argument("head")
+    parser.add_argument("--fail-above", type=float, default=None, help="允许的最大退化百分比")
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+
+    print(f"base {base.get('commit')}  head {head.get('commit')}")
+    print(f"{'rpc':<22}{'rps':>22}{'p50 ms':>22}{'p95 ms':>22}{'p99 ms':>22}")
+    regressions = []
+    for rpc, stats in head["rpcs"].items():
+        old = base["rpcs"].get(rpc, {})
+        row = f"{rpc:<22}"
+        for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms"):
+            change = _change(old.get(key), stats.get(key))
+            row += f"{_fmt(stats.get(key), change):>22}"
+            if args.fail_above is None or change is None:
+                continue
+            # 吞吐越低越差，延迟越高越差
+            worse = -change if key == "throughput_rps" else change
+            if key in ("throughput_rps", "p95_ms") and worse > args.fail_above:
+                regressions.append(f"{rpc} {key} {change:+.1f}%")
+        print(row)
+
+    for cache, stats in head.get("caches", {}).items():
+        old = base.get("caches", {}).get(cache, {})
+        print(f"cache {cache:<16} hit rate {old.get('hit_rate')} -> {stats.get('hit_rate')}")
+
+    if regressions:
+        print("regressions: " + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
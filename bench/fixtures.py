@@ -0,0 +1,62 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+
+def make_images(count: int, size: tuple = (1280, 960), seed: int = 0) -> list[bytes]:
+    """生成固定随机种子的 JPEG：平滑渐变叠加噪声，大小和解码开销接近真实照片"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    ys, xs = np.mgrid[0:height, 0:width]
+    images = []
+    for _ in range(count):
+        base = rng.uniform(0, 255, size=3)
+        slope = rng.uniform(-0.2, 0.2, size=(2, 3))
+        pixels = base + xs[..., None] * slope[0] + ys[..., None] * slope[1]
+        pixels += rng.normal(0, 12, size=pixels.shape)
+        buffer = BytesIO()
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, "JPEG", quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+class FixtureServer:
+    """本地图片服务器：GET /images/<i>.jpg 返回第 i 张图片，不依赖外网"""
+
+    def __init__(self, images: list[bytes], host: str = "127.0.0.1", port: int = 0):
+        self.images = images
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    index = int(self.path.rsplit("/", 1)[-1].split(".")[0])
+                    body = fixture.images[index]
+                except (ValueError, IndexError):
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.base_url = f"http://{host}:{self._server.server_address[1]}"
+
+    def url(self, index: int) -> str:
+        return f"{self.base_url}/images/{index}.jpg"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="fixture-http", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
@@ -0,0 +1,270 @@
+"""
+离线基准测试：本地图片服务器 + 子进程里的真实 VisionServer，通过 gRPC 按指定并发和请求配比压测。
+默认把三个模型换成 bench.stubs 里的桩模型（只替换模型前向，服务里的批处理、缓存和后处理照常执行），
+不需要 GPU 和外网；--real-models 时加载真实模型。
+
+    python codegen.py
+    python -m bench.run --duration 30 --concurrency 32 --output bench/results/$(git rev-parse --short HEAD).json
+    python -m bench.compare bench/results/base.json bench/results/head.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import grpc
+import numpy as np
+from grpc_health.v1 import health_pb2, health_pb2_grpc
+
+import vision_pb2
+import vision_pb2_grpc
+from bench.fixtures import FixtureServer, make_images
+
+default_mix = "EmbedText=4,EmbedImage=4,ExtractText=2,GenerateTags=1,GenerateCaption=1,ParseQueryToGraph=1"
+stub_classes = "embedding=bench.stubs:StubEmbedder,ocr=bench.stubs:StubOCR,caption=bench.stubs:StubCaption"
+queries = ["奔跑的男人", "在睡觉的橘猫", "红色的法拉利", "雪山日出", "海边的灯塔", "城市夜景", "一碗拉面", "下雨的街道"]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _parse_mix(spec: str) -> dict:
+    mix = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        rpc, _, weight = item.partition("=")
+        mix[rpc.strip()] = float(weight or 1)
+    return mix
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+class Workload:
+    """按 RPC 名构造请求并调用，返回 (首包耗时, 总耗时)；流式接口的首包耗时是第一帧到达的时间"""
+
+    def __init__(self, stub, fixture: FixtureServer, image_count: int, batch_size: int, rng: random.Random):
+        self.stub = stub
+        self.fixture = fixture
+        self.image_count = image_count
+        self.batch_size = batch_size
+        self.rng = rng
+
+    def _url(self) -> str:
+        return self.fixture.url(self.rng.randrange(self.image_count))
+
+    def _query(self) -> str:
+        return f"{self.rng.choice(queries)}{self.rng.randrange(1000)}"
+
+    def request(self, rpc: str):
+        if rpc in ("EmbedText", "ParseQueryToGraph"):
+            return vision_pb2.TextRequest(text=self._query())
+        if rpc == "EmbedImage":
+            return vision_pb2.ImageRequest(url=self._url())
+        if rpc == "EmbedTexts":
+            return vision_pb2.TextBatchRequest(texts=[self._query() for _ in range(self.batch_size)])
+        if rpc == "EmbedImages":
+            return vision_pb2.ImageBatchRequest(urls=[self._url() for _ in range(self.batch_size)])
+        if rpc == "ExtractTextBatch":
+            return vision_pb2.GenBatchRequest(image_urls=[self._url() for _ in range(self.batch_size)])
+        return vision_pb2.GenRequest(image_url=self._url())
+
+    async def call(self, rpc: str, timeout: float):
+        method = getattr(self.stub, rpc)
+        request = self.request(rpc)
+        start = time.perf_counter()
+        if rpc == "GenerateCaption":
+            first = None
+            async for _ in method(request, timeout=timeout):
+                if first is None:
+                    first = time.perf_counter() - start
+            return first, time.perf_counter() - start
+        await method(request, timeout=timeout)
+        elapsed = time.perf_counter() - start
+        return elapsed, elapsed
+
+
+def _percentiles(values: list) -> dict:
+    if not values:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "mean_ms": None}
+    p50, p95, p99 = np.percentile(np.array(values) * 1000, [50, 95, 99])
+    return {"p50_ms": round(p50, 2), "p95_ms": round(p95, 2), "p99_ms": round(p99, 2),
+            "mean_ms": round(float(np.mean(values)) * 1000, 2)}
+
+
+async def run_load(target: str, fixture: FixtureServer, args) -> dict:
+    mix = _parse_mix(args.mix)
+    rpcs, weights = list(mix), list(mix.values())
+    samples = {rpc: {"latency": [], "first": [], "errors": {}} for rpc in rpcs}
+
+    async with grpc.aio.insecure_channel(target) as channel:
+        stub = vision_pb2_grpc.VisionServiceStub(channel)
+
+        async def worker(worker_id: int, deadline: float, record: bool):
+            rng = random.Random(args.seed * 1000 + worker_id)
+            workload = Workload(stub, fixture, args.images, args.batch_size, rng)
+            while time.perf_counter() < deadline:
+                rpc = rng.choices(rpcs, weights)[0]
+                try:
+                    first, latency = await workload.call(rpc, args.timeout)
+                except grpc.aio.AioRpcError as e:
+                    if record:
+                        errors = samples[rpc]["errors"]
+                        errors[e.code().name] = errors.get(e.code().name, 0) + 1
+                    continue
+                if record:
+                    samples[rpc]["latency"].append(latency)
+                    if first is not None:
+                        samples[rpc]["first"].append(first)
+
+        if args.warmup > 0:
+            deadline = time.perf_counter() + args.warmup
+            await asyncio.gather(*(worker(i, deadline, False) for i in range(args.concurrency)))
+
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*(worker(i, deadline, True) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+    report = {}
+    total = 0
+    for rpc, sample in samples.items():
+        count = len(sample["latency"])
+        total += count
+        report[rpc] = {
+            "count": count,
+            "errors": sample["errors"],
+            "throughput_rps": round(count / elapsed, 2),
+            **_percentiles(sample["latency"]),
+        }
+        if rpc == "GenerateCaption":
+            report[rpc]["first_frame"] = _percentiles(sample["first"])
+    return {"elapsed_s": round(elapsed, 2), "throughput_rps": round(total / elapsed, 2), "rpcs": report}
+
+
+_metric_line = re.compile(r'^(\w+)\{(.*)}\s+(\S+)$')
+
+
+def scrape_metrics(url: str) -> dict:
+    """从 /metrics 读出缓存命中率和各阶段平均耗时"""
+    text = urllib.request.urlopen(url, timeout=5).read().decode()
+    caches, stages = {}, {}
+    for line in text.splitlines():
+        match = _metric_line.match(line)
+        if match is None:
+            continue
+        name, labels, value = match.group(1), dict(re.findall(r'(\w+)="([^"]*)"', match.group(2))), float(match.group(3))
+        if name == "vision_cache_requests_total":
+            caches.setdefault(labels["cache"], {})[labels["result"]] = value
+        elif name in ("vision_stage_latency_seconds_sum", "vision_stage_latency_seconds_count"):
+            key = f"{labels['stage']}/{labels['model']}"
+            stages.setdefault(key, {})[name.rsplit("_", 1)[-1]] = value
+
+    cache_report = {}
+    for cache, counts in caches.items():
+        hits, misses = counts.get("hit", 0), counts.get("miss", 0)
+        lookups = hits + misses
+        cache_report[cache] = {"hits": int(hits), "misses": int(misses),
+                               "hit_rate": round(hits / lookups, 4) if lookups else None}
+    stage_report = {key: {"count": int(v.get("count", 0)),
+                          "mean_ms": round(v["sum"] / v["count"] * 1000, 3) if v.get("count") else None}
+                    for key, v in stages.items()}
+    return {"caches": cache_report, "stages": stage_report}
+
+
+def wait_until_serving(target: str, process, timeout: float):
+    channel = grpc.insecure_channel(target)
+    health = health_pb2_grpc.HealthStub(channel)
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"server exited with code {process.returncode}")
+            try:
+                status = health.Check(health_pb2.HealthCheckRequest(service=""), timeout=1).status
+                if status == health_pb2.HealthCheckResponse.SERVING:
+                    return
+            except grpc.RpcError:
+                pass
+            time.sleep(0.2)
+        raise TimeoutError(f"server not SERVING after {timeout}s")
+    finally:
+        channel.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=20, help="计时阶段时长（秒）")
+    parser.add_argument("--warmup", type=float, default=3, help="不计入结果的预热时长（秒）")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发的客户端协程数")
+    parser.add_argument("--mix", default=default_mix, help="请求配比，RPC=权重，逗号分隔")
+    parser.add_argument("--images", type=int, default=200, help="图片池大小，越小缓存命中越多")
+    parser.add_argument("--image-size", default="1280x960")
+    parser.add_argument("--batch-size", type=int, default=8, help="批量接口每个请求的条数")
+    parser.add_argument("--timeout", type=float, default=30, help="单个 RPC 的 deadline（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--real-models", action="store_true", help="加载真实模型而不是桩模型")
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    parser.add_argument("--output", help="结果 JSON 的保存路径")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.image_size.split("x"))
+    fixture = FixtureServer(make_images(args.images, (width, height), args.seed)).start()
+
+    grpc_port, metrics_port = _free_port(), _free_port()
+    # 向量库照常启用，但每次运行用一个新的空目录；持久化的向量库和结果缓存会让多次运行的结果互相影响
+    store_dir = tempfile.TemporaryDirectory(prefix="bench-embeddings-")
+    env = dict(os.environ,
+               GRPC_PORT=str(grpc_port), METRICS_PORT=str(metrics_port), METRICS_ADDR="127.0.0.1",
+               LOG_LEVEL=os.getenv("LOG_LEVEL", "WARNING"),
+               EMBEDDING_STORE_DIR=store_dir.name, RESULT_CACHE_ENABLED="0")
+    if not args.real_models:
+        env["VISION_SERVICE_CLASSES"] = stub_classes
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    server = subprocess.Popen([sys.executable, os.path.join(root, "server.py")], cwd=root, env=env)
+
+    target = f"127.0.0.1:{grpc_port}"
+    try:
+        started = time.perf_counter()
+        wait_until_serving(target, server, args.startup_timeout)
+        startup_s = time.perf_counter() - started
+        load = asyncio.run(run_load(target, fixture, args))
+        server_metrics = scrape_metrics(f"http://127.0.0.1:{metrics_port}/metrics")
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        fixture.stop()
+        store_dir.cleanup()
+
+    result = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {**vars(args), "models": "real" if args.real_models else "stub"},
+        "startup_s": round(startup_s, 2),
+        **load,
+        **server_metrics,
+    }
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import hashlib
+import os
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from transformers import BatchFeature
+
+from core.embedding_service import ChineseClipEmbedder
+from core.generation_engine import GenerationBackend, GenerationEngine
+from core.ocr_service import OCRService, rec_batch_num
+from utils.image_loader import get_preprocessed
+from utils.metrics import stage
+
+# 桩模型的“前向”耗时，用来模拟不同的模型开销
+forward_ms = float(os.getenv("STUB_FORWARD_MS", "2"))
+token_ms = float(os.getenv("STUB_TOKEN_MS", "5"))
+stream_tokens = int(os.getenv("STUB_STREAM_TOKENS", "64"))
+embedding_dim = 512
+
+
+def _forward():
+    time.sleep(forward_ms / 1000)
+
+
+def _vector(data: bytes) -> np.ndarray:
+    seed = int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+    vector = np.random.default_rng(seed).standard_normal(embedding_dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def _thumbnail(image) -> np.ndarray:
+    return np.asarray(image.resize((32, 32)), dtype=np.uint8)
+
+
+class _StubClipProcessor:
+    """代替 ChineseCLIPProcessor：文本按 UTF-8 字节编码成 token，图片缩成 32x32"""
+
+    def __call__(self, text=None, images=None, padding=True, return_tensors="pt"):
+        if images is not None:
+            pixels = np.stack([_thumbnail(image.convert("RGB")).transpose(2, 0, 1) for image in images])
+            return BatchFeature({"pixel_values": torch.from_numpy(pixels.astype(np.float32) / 255)})
+        encoded = [list(t.encode()) for t in text]
+        width = max(map(len, encoded))
+        input_ids = torch.zeros((len(encoded), width), dtype=torch.long)
+        attention_mask = torch.zeros((len(encoded), width), dtype=torch.long)
+        for i, ids in enumerate(encoded):
+            input_ids[i, :len(ids)] = torch.tensor(ids)
+            attention_mask[i, :len(ids)] = 1
+        return BatchFeature({"input_ids": input_ids, "attention_mask": attention_mask})
+
+
+class _StubClipModel:
+    """代替 ChineseCLIPModel：每次前向（不论批次大小）固定耗时，向量由输入内容决定"""
+
+    config = SimpleNamespace(projection_dim=embedding_dim)
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+    def get_text_features(self, input_ids, attention_mask):
+        _forward()
+        rows = [_vector(ids[mask.bool()].cpu().numpy().tobytes()) for ids, mask in zip(input_ids, attention_mask)]
+        return torch.from_numpy(np.stack(rows))
+
+    def get_image_features(self, pixel_values):
+        _forward()
+        return torch.from_numpy(np.stack([_vector(pixels.cpu().numpy().tobytes()) for pixels in pixel_values]))
+
+
+class StubEmbedder(ChineseClipEmbedder):
+    """
+    真实的 ChineseClipEmbedder，只把处理器和模型换成桩：下载、预处理缓存、微批处理、向量库和进程池都照常执行。
+    """
+
+    model_name = "stub-clip"
+
+    def _load_processor(self):
+        return _StubClipProcessor()
+
+    def _load_model(self):
+        return _StubClipModel()
+
+    def _load_config(self):
+        return _StubClipModel.config
+
+
+class _StubPaddleOCR:
+    """
+    代替 PaddleOCR 的三个预测器。检测按图片平均亮度给出 0-3 个横条文本框（0 个时走无文字的提前返回），
+    识别每 rec_batch_num 行一次前向，约三分之一的行给低置信度，由 _clean_lines 过滤掉。
+    """
+
+    def text_detector(self, img_array):
+        _forward()
+        h, w = img_array.shape[:2]
+        count = int(img_array[::16, ::16].mean()) % 4
+        band = h / 4
+        boxes = [[[0, i * band], [w, i * band], [w, (i + 1) * band], [0, (i + 1) * band]] for i in range(count)]
+        return np.array(boxes, dtype=np.float32).reshape(count, 4, 2), 0.0
+
+    def text_classifier(self, crops):
+        _forward()
+        return crops, [("0", 1.0)] * len(crops), 0.0
+
+    def text_recognizer(self, crops):
+        rec_res = []
+        for start in range(0, len(crops), rec_batch_num):
+            _forward()
+            for crop in crops[start:start + rec_batch_num]:
+                value = int(crop[::8, ::8].mean())
+                rec_res.append((f"桩文字{value}", 0.3 if value % 3 == 0 else 0.9))
+        return rec_res, 0.0
+
+
+def _sorted_boxes(dt_boxes):
+    return sorted(dt_boxes, key=lambda box: (box[0][1], box[0][0]))
+
+
+def _crop(img_array, box):
+    (left, top), (right, bottom) = box.min(axis=0).astype(int), box.max(axis=0).astype(int)
+    return img_array[top:bottom, left:right]
+
+
+class StubOCR(OCRService):
+    """真实的 OCRService，只把 PaddleOCR 预测器换成桩：预筛、多图合批识别和 _clean_lines 都照常执行"""
+
+    def _load_model(self):
+        self.ocr = _StubPaddleOCR()
+        self._sorted_boxes = _sorted_boxes
+        self._crop = _crop
+
+
+class _StubBackend(GenerationBackend):
+    def start(self, request):
+        time.sleep(forward_ms / 1000)
+        return [0]
+
+    def step(self, states: list) -> list:
+        time.sleep(token_ms / 1000)
+        results = []
+        for state in states:
+            state[0] += 1
+            results.append((f"字{state[0]}", False))
+        return results
+
+
+class StubCaption:
+    """
+    接口与 CaptionService 相同，生成走真实的 GenerationEngine 调度，只把后端换成按固定速度吐 token 的桩；
+    不接结果缓存，cache_only 查询总是未命中。
+    """
+
+    model_path = "stub-vlm"
+
+    def __init__(self):
+        self.engine = GenerationEngine(_StubBackend(), int(os.getenv("VLM_MAX_CONCURRENT_SEQS", "4")),
+                                       int(os.getenv("VLM_MAX_PENDING_SEQS", "16")))
+
+    def _run(self, image_url, image, max_tokens: int, cache_only: bool):
+        if cache_only:
+            return False
+        if image_url is not None:
+            get_preprocessed(image_url, self.model_path, "vlm", _thumbnail, image)
+        with stage("forward", self.model_path):
+            self.engine.submit({}, max_tokens).result()
+        return True
+
+    def generate_name(self, image_url, image=None, bypass_cache=False, cache_only=False, cache_checked=False):
+        return "桩图标题" if self._run(image_url, image, 4, cache_only) else None
+
+    def generate_tags(self, image_url, image=None, bypass_cache=False, cache_only=False, cache_checked=False):
+        return ["桩", "标签", "基准"] if self._run(image_url, image, 16, cache_only) else None
+
+    def extract_graph_triples(self, image_url, image=None, bypass_cache=False, cache_only=False, cache_checked=False):
+        triples = [{"s": "桩", "p": "位于", "o": "图片"}]
+        return triples if self._run(image_url, image, 32, cache_only) else None
+
+    def analyze_image(self, image_url, image=None, bypass_cache=False, cache_only=False, cache_checked=False):
+        if not self._run(image_url, image, 48, cache_only):
+            return None
+        return {"name": "桩图标题", "tags": ["桩", "标签"], "triples": [{"s": "桩", "p": "位于", "o": "图片"}]}
+
+    def parse_query_to_graph(self, query, bypass_cache=False, cache_only=False, cache_checked=False):
+        return [{"s": query[:4], "p": "是", "o": "查询"}] if self._run(None, None, 24, cache_only) else None
+
+    def start_stream(self, image_url, prompt, image=None):
+        get_preprocessed(image_url, self.model_path, "vlm", _thumbnail, image)
+        return self.engine.submit({}, stream_tokens)
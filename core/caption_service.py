@@ -1,12 +1,43 @@
 import json
 import os
 import re
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import mlx.core as mx
+import numpy as np
+from PIL import Image
+from mlx_vlm import load
+
+from core.generation_engine import GenerationEngine
+from core.mlx_backend import MlxVlmBackend
+from core.prefix_cache import PrefixCache
+from core.result_cache import ResultCache, create_result_cache
+from core.structured_output import JsonStop, first_line_stop
+from utils import deadlines
+from utils.image_loader import get_image_bytes, get_preprocessed
+from utils.log import get_logger
+from utils.metrics import stage
+
+image_pad_token = "<|image_pad|>"
+max_concurrent_seqs = int(os.getenv("VLM_MAX_CONCURRENT_SEQS", "4"))
+# 等待解码槽位的序列上限（流式和阻塞接口共用），超出时返回 RESOURCE_EXHAUSTED
+max_pending_seqs = int(os.getenv("VLM_MAX_PENDING_SEQS", "16"))
+max_tags = 5
+max_triples = int(os.getenv("VLM_MAX_TRIPLES", "10"))
+# 前缀 KV 缓存最多保留的前缀数，每条都是一份完整的 KV 缓存
+prefix_cache_entries = int(os.getenv("VLM_PREFIX_CACHE_ENTRIES", "8"))
+_fallback_results = ([], ["未分类"], "未命名图片")
+
+
+def _is_fallback(result) -> bool:
+    """解析失败时的兜底结果不写缓存；analyze_image 的字典结果每个字段都是兜底值时才算"""
+    if isinstance(result, dict):
+        return all(value in _fallback_results for value in result.values())
+    return result in _fallback_results
 
-from mlx_vlm import load, generate
-
-from utils.image_loader import get_image_smart
 
 os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
+logger = get_logger("caption")
 
 
 def _clean_json_output(text: str):
@@ -82,10 +113,10 @@ def _clean_tags_output(raw_text: str) -> list[str]:
         if not clean_tags:
             return ["未分类"]
 
-        return clean_tags[:5]
+        return clean_tags[:max_tags]
 
     except Exception as e:
-        print(f"❌ Tags parsing error: {e}, raw: {raw_text}")
+        logger.warning("tags parsing failed", error=e, raw=raw_text)
         return ["未分类"]
 
 
@@ -108,22 +139,146 @@ def _clean_graph_triples(text: str):
                     triples.append(obj)
             except:
                 continue
-        print(f"✅ Graph extracted: {len(triples)} triples")
+        logger.debug("graph extracted", triples=len(triples), sampled=True)
         return triples
     except Exception as e:
-        print(f"❌ Parsing Error: {e}")
+        logger.warning("graph parsing failed", error=e)
         return []
 
 
+def _clean_analysis_output(text: str) -> dict:
+    """拆开一次生成的 {name, tags, triples}，每一部分仍交给各自的清洗函数校验"""
+    text = re.sub(r"```json\s*", "", text or "")
+    text = re.sub(r"```\s*$", "", text).strip()
+    try:
+        match = re.search(r'\{.*}', text, re.DOTALL)
+        obj = json.loads(match.group()) if match else {}
+        if not isinstance(obj, dict):
+            obj = {}
+    except json.JSONDecodeError:
+        obj = {}
+
+    # JSON 不完整时逐个字段从原文里抠
+    if "name" in obj:
+        name_text = str(obj["name"])
+    else:
+        name_match = re.search(r'"name"\s*:\s*"(.*?)"', text)
+        name_text = name_match.group(1) if name_match else ""
+
+    if "tags" in obj:
+        tags_text = json.dumps(obj["tags"], ensure_ascii=False)
+    else:
+        tags_match = re.search(r'"tags"\s*:\s*(\[.*?])', text, re.DOTALL)
+        tags_text = tags_match.group(1) if tags_match else ""
+
+    if "triples" in obj:
+        triples_text = json.dumps(obj["triples"], ensure_ascii=False)
+    else:
+        triples_start = text.find('"triples"')
+        triples_text = text[triples_start:] if triples_start >= 0 else ""
+
+    return {
+        "name": _clean_and_validate_title(name_text),
+        "tags": _clean_tags_output(tags_text),
+        "triples": _clean_graph_triples(triples_text),
+    }
+
+
 class CaptionService:
     def __init__(self):
         self.model_path = "mlx-community/Qwen2.5-VL-7B-Instruct-4bit"
-        print(f"🔄 Loading: {self.model_path} ...")
+        logger.info("loading model", model=self.model_path)
         self.model, self.processor = load(self.model_path)
-        print(f"✅ {self.model_path} loaded")
+        logger.info("model loaded", model=self.model_path)
+        self.result_cache = create_result_cache()
+        # 所有生成都交给同一个引擎线程，多条序列在 token 边界交替前进
+        self.engine = GenerationEngine(MlxVlmBackend(self.model, self.processor), max_concurrent_seqs,
+                                       max_pending_seqs)
+        self.prefix_cache = PrefixCache(self.model, self.processor, runner=self.engine.call,
+                                        max_entries=prefix_cache_entries)
+
+    def warmup(self):
+        """
+        一次带图片的短生成预热视觉编码器和解码；再跑一次查询解析，顺带建好它的前缀缓存。
+        直接传入图片对象，不会写入任何缓存。
+        """
+        image = Image.new("RGB", (224, 224), "white")
+        self._generate(self._image_inputs(image, None, "描述这张图片"), max_tokens=2)
+        self.parse_query_to_graph("热身", bypass_cache=True)
+
+    def _generate(self, inputs: dict, max_tokens: int, stop=None, **sampling) -> str:
+        deadlines.check("forward")
+        with stage("forward", self.model_path):
+            request = self.engine.submit(inputs, max_tokens, stop=stop, **sampling)
+            try:
+                return request.result(deadlines.remaining())
+            except FutureTimeoutError:
+                # 调用方已经超时：在下一个 token 边界停止生成，把解码槽位让给别的请求。
+                # 等引擎真正结束这条序列再返回，调用方随后可能要裁剪或复用它用过的 KV 缓存
+                request.cancel()
+                request.wait()
+                raise deadlines.DeadlineExceededError("deadline exceeded during generation") from None
+
+    def _generate_json(self, inputs: dict, prefix: str, max_items: int = None, **params) -> str:
+        """
+        生成 JSON：prefix（"[" 或 "{"）已预填在回复开头，顶层闭合或元素数达到 max_items 时立即停止，
+        返回补全后的 JSON 文本，交给各自的清洗函数。
+        """
+        stop = JsonStop(prefix, max_items)
+        self._generate(inputs, stop=stop, **params)
+        return stop.repair()
 
-    def generate_name(self, image_url: str):
-        image = get_image_smart(image_url)
+    def _cached(self, endpoint: str, content, prompt: str, params: dict, bypass_cache: bool, cache_only: bool,
+                cache_checked: bool, compute):
+        """
+        结果缓存：content 为图片 URL 或查询文本；传入已解码的图片时无法按内容寻址，直接计算。
+        cache_only=True 时只查缓存，未命中返回 None，供服务端在进入模型通道之前先查一次；
+        cache_checked=True 表示调用方刚查过且未命中，跳过查询直接计算并写回，避免一次未命中计两次。
+        """
+        if self.result_cache is None or bypass_cache or not isinstance(content, str):
+            return None if cache_only else compute()
+
+        data = get_image_bytes(content) if endpoint != "query_graph" else content.strip().encode()
+        key = ResultCache.make_key(endpoint, data, prompt, params)
+        result = None if cache_checked else self.result_cache.get(key)
+        if result is None and not cache_only:
+            result = compute()
+            # 解析失败时的兜底结果不缓存，下次还有机会生成成功
+            if not _is_fallback(result):
+                self.result_cache.put(key, result)
+        return result
+
+    def _preprocess_image(self, image):
+        features = self.processor.image_processor(images=[image], return_tensors="np")
+        return {
+            "pixel_values": mx.array(features["pixel_values"]),
+            "image_grid_thw": mx.array(features["image_grid_thw"]),
+        }
+
+    def _image_inputs(self, image_url, image, prompt: str, response_prefix: str = "") -> dict:
+        """
+        组装带图片的模型输入。图片特征按 (URL, 模型) 缓存，同一张图的多个提示词共用；
+        只有提示词部分需要每次重新分词，图片占位符按网格大小展开。
+        response_prefix 预填在助手回复的开头，约束模型从这里接着写。
+        """
+        features = get_preprocessed(image_url, self.model_path, "vlm", self._preprocess_image, image)
+        formatted_prompt = self.processor.apply_chat_template(
+            [{"role": "user", "content": [{"type": "image"}, {"type": "text", "text": prompt}]}],
+            add_generation_prompt=True,
+        ) + response_prefix
+        merge_length = self.processor.image_processor.merge_size ** 2
+        image_tokens = int(np.prod(np.array(features["image_grid_thw"][0]))) // merge_length
+        expanded = formatted_prompt.replace(image_pad_token, image_pad_token * image_tokens, 1)
+        input_ids = mx.array(self.processor.tokenizer(expanded, return_tensors="np")["input_ids"])
+        return {
+            "prompt": formatted_prompt,
+            "input_ids": input_ids,
+            "mask": mx.ones_like(input_ids),
+            **features,
+        }
+
+    def generate_name(self, image_url: str, image=None, bypass_cache: bool = False, cache_only: bool = False,
+                      cache_checked: bool = False):
         prompt = """
         为这张图片起一个3-6字的中文标题，要求美感、简洁、诗意。
         不能有除中文外的其他字符或者标点符号。标题不能超过6个字。
@@ -135,47 +290,37 @@ class CaptionService:
         图片内容：繁华的城市夜景
         标题：城市霓虹
         """
-        formatted_prompt = self.processor.apply_chat_template(
-            [{"role": "user", "content": [{"type": "image"}, {"type": "text", "text": prompt}]}],
-            add_generation_prompt=True,
-        )
-        output = generate(
-            self.model,
-            self.processor,
-            image=image,
-            prompt=formatted_prompt,
-            verbose=False,
-            max_tokens=10,
-            temp=0.5
-        )
-        return _clean_and_validate_title(output)
-
-    def generate_tags(self, image_url: str):
-        image = get_image_smart(image_url)
+        params = {"max_tokens": 10, "temp": 0.5}
+
+        def run():
+            inputs = self._image_inputs(image_url, image, prompt)
+            output = self._generate(inputs, stop=first_line_stop, **params)
+            with stage("postprocess", self.model_path):
+                return _clean_and_validate_title(output)
+
+        return self._cached("name", image_url, prompt, params, bypass_cache, cache_only, cache_checked, run)
+
+    def generate_tags(self, image_url: str, image=None, bypass_cache: bool = False, cache_only: bool = False,
+                      cache_checked: bool = False):
         prompt = """
         分析图片，提取3-5个核心中文标签(物体、场景、风格)。
         严格返回JSON字符串数组，例如：["风景", "雪山", "日落"]。
         不要输出Markdown格式，不要输出任何解释性文字。标签数量不要少于3个
         """
+        params = {"max_tokens": 64, "temp": 0.7}
+        decoding = {"prefix": "[", "max_items": max_tags}
 
-        formatted_prompt = self.processor.apply_chat_template(
-            [{"role": "user", "content": [{"type": "image"}, {"type": "text", "text": prompt}]}],
-            add_generation_prompt=True,
-        )
-
-        output = generate(
-            self.model,
-            self.processor,
-            image=image,
-            prompt=formatted_prompt,
-            verbose=False,
-            max_tokens=200,
-            temp=0.7
-        )
-        return _clean_tags_output(output)
-
-    def extract_graph_triples(self, image_url: str):
-        image = get_image_smart(image_url)
+        def run():
+            inputs = self._image_inputs(image_url, image, prompt, decoding["prefix"])
+            output = self._generate_json(inputs, **decoding, **params)
+            with stage("postprocess", self.model_path):
+                return _clean_tags_output(output)
+
+        return self._cached("tags", image_url, prompt, {**params, **decoding}, bypass_cache, cache_only,
+                            cache_checked, run)
+
+    def extract_graph_triples(self, image_url: str, image=None, bypass_cache: bool = False, cache_only: bool = False,
+                              cache_checked: bool = False):
         prompt = """
                 请分析图片，提取图中主要物体之间的 SPO 三元组。
                 请以 JSON 数组格式返回，每个元素包含三个字段：
@@ -194,51 +339,63 @@ class CaptionService:
                 
                 请输出 JSON 数组，不要Markdown代码块，必须是中文。
         """
+        params = {"max_tokens": 256, "temp": 0.3, "repetition_penalty": 1.0, "do_sample": True, "top_p": 0.9}
+        decoding = {"prefix": "[", "max_items": max_triples}
 
-        formatted_prompt = self.processor.apply_chat_template(
-            [{"role": "user", "content": [{"type": "image"}, {"type": "text", "text": prompt}]}],
-            add_generation_prompt=True,
-        )
-        output = generate(
-            self.model,
-            self.processor,
-            image=image,
-            prompt=formatted_prompt,
-            verbose=False,
-            max_tokens=256,
-            temp=0.3,
-            repetition_penalty=1.0,
-            do_sample=True,
-            top_p=0.9
-        )
-
-        return _clean_graph_triples(output)
-
-    def stream_generate(self, image_url: str, prompt: str):
-        image = get_image_smart(image_url)
+        def run():
+            inputs = self._image_inputs(image_url, image, prompt, decoding["prefix"])
+            output = self._generate_json(inputs, **decoding, **params)
+            with stage("postprocess", self.model_path):
+                return _clean_graph_triples(output)
 
-        formatted_prompt = self.processor.apply_chat_template(
-            [{"role": "user", "content": [{"type": "image"}, {"type": "text", "text": prompt}]}],
-            add_generation_prompt=True,
-        )
-
-        # 使用流式生成模式
-        stream_output = generate(
-            self.model,
-            self.processor,
-            image=image,
-            prompt=formatted_prompt,
-            verbose=False,
-            max_tokens=500,
-            temp=0.7,
-            stream=True  # 启用流式输出
-        )
-
-        # 逐个yield生成的token
-        for chunk in stream_output:
-            yield chunk
-
-    def parse_query_to_graph(self, query: str):
+        return self._cached("triples", image_url, prompt, {**params, **decoding}, bypass_cache, cache_only,
+                            cache_checked, run)
+
+    def analyze_image(self, image_url: str, image=None, bypass_cache: bool = False, cache_only: bool = False,
+                      cache_checked: bool = False):
+        """一次生成同时得到标题、标签和三元组，图片只过一遍视觉编码器和预填充"""
+        prompt = """
+                请分析这张图片，严格按下面的 JSON 对象格式输出，不要Markdown代码块，不要任何解释性文字：
+                {"name": "标题", "tags": ["标签1", "标签2", "标签3"], "triples": [{"s": "主体", "p": "关系", "o": "客体"}]}
+                
+                - "name": 3-6字的中文标题，要求美感、简洁、诗意，只能包含中文，不能有标点符号。
+                - "tags": 3-5个核心中文标签(物体、场景、风格)。
+                - "triples": 图中主要物体之间的 SPO 三元组，"s" 为主体(名词)，"p" 为关系(如：位于、拿着、穿着、包含，动词/介词)，"o" 为客体(名词)。
+                
+                【示例】：
+                输入：一张男人站在山顶看日出的图。
+                输出：
+                {"name": "山巅日出", "tags": ["日出", "雪山", "登山"], "triples": [{"s": "男子", "p": "站在", "o": "山顶"}, {"s": "男子", "p": "面向", "o": "太阳"}]}
+                
+                所有内容必须是中文。
+        """
+        params = {"max_tokens": 384, "temp": 0.3, "top_p": 0.9}
+        decoding = {"prefix": "{"}
+
+        def run():
+            inputs = self._image_inputs(image_url, image, prompt, decoding["prefix"])
+            output = self._generate_json(inputs, **decoding, **params)
+            with stage("postprocess", self.model_path):
+                return _clean_analysis_output(output)
+
+        return self._cached("analyze", image_url, prompt, {**params, **decoding}, bypass_cache, cache_only,
+                            cache_checked, run)
+
+    def start_stream(self, image_url: str, prompt: str, image=None):
+        """预处理图片并提交生成，立即返回在途请求；调用方负责消费结果，不再需要时 cancel()"""
+        inputs = self._image_inputs(image_url, image, prompt)
+        return self.engine.submit(inputs, max_tokens=500, temp=0.7)
+
+    def stream_generate(self, image_url: str, prompt: str, image=None):
+        # 使用流式生成模式，逐段产出生成的文本；调用方提前停止迭代时取消生成
+        request = self.start_stream(image_url, prompt, image)
+        try:
+            yield from request
+        finally:
+            request.cancel()
+
+    def parse_query_to_graph(self, query: str, bypass_cache: bool = False, cache_only: bool = False,
+                             cache_checked: bool = False):
         system_prompt = """
                 你是一个搜索意图解析器。请提取用户查询中的【实体关系】，并标准为 JSON 三元组。
                 - "s": Subject (主体，名词)
@@ -262,22 +419,35 @@ class CaptionService:
             }
         ]
 
+        params = {"max_tokens": 256, "temperature": 0.1}
+        decoding = {"prefix": "[", "max_items": max_triples}
         text = self.processor.apply_chat_template(
             messages, tokenize=False, add_generation_prompt=True
-        )
-
-        output = generate(
-            self.model,
-            self.processor,
-            prompt=text,
-            max_tokens=256,
-            temperature=0.1,
-            verbose=False
-        )
-        return _clean_json_output(output)
-
+        ) + decoding["prefix"]
+        # 用户输入之前的部分（对话模板 + 指令 + 示例）每次都一样，只预填充一次；
+        # 按固定指令在模板里的位置切分，不能按"输入："搜索，否则用户输入里的同样字样会被切进前缀
+        split = text.index(system_prompt) + len(system_prompt) + 1
+        prefix, suffix = text[:split], text[split:]
+
+        def run():
+            with self.prefix_cache.use(prefix, suffix) as prompt_cache:
+                if prompt_cache is not None:
+                    try:
+                        output = self._generate_json({"prompt": suffix, "prompt_cache": prompt_cache},
+                                                     **decoding, **params)
+                        return _clean_json_output(output)
+                    except deadlines.DeadlineExceededError:
+                        # 超时与前缀缓存无关，不能因此关掉缓存
+                        raise
+                    except Exception as e:
+                        logger.warning("prefix cache failed, falling back to full prefill", error=e)
+                        self.prefix_cache.disable(prefix)
+            output = self._generate_json({"prompt": text}, **decoding, **params)
+            return _clean_json_output(output)
+
+        return self._cached("query_graph", query, system_prompt, {**params, **decoding}, bypass_cache, cache_only,
+                            cache_checked, run)
 
-caption_service = CaptionService()
 
 if __name__ == "__main__":
     service = CaptionService()
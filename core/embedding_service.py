@@ -1,50 +1,252 @@
+import os
+import time
+from concurrent.futures import Future
+
 import torch
-from transformers import ChineseCLIPProcessor, ChineseCLIPModel
+from PIL import Image
+from transformers import ChineseCLIPConfig, ChineseCLIPProcessor, ChineseCLIPModel
+
+from core.embedding_store import EmbeddingStore
+from core.vector_index import VectorIndex, VectorIndexDisabledError
+from utils import deadlines
+from utils.batcher import MicroBatcher
+from utils.image_loader import get_image_digest, get_preprocessed, map_concurrent
+from utils.log import get_logger
+from utils.metrics import stage, stage_latency
+
+logger = get_logger("embedding")
+
+max_batch_size = int(os.getenv("EMBED_MAX_BATCH_SIZE", "32"))
+max_wait_ms = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))
+# 持久化向量库目录，设为空字符串关闭
+store_dir = os.getenv("EMBEDDING_STORE_DIR", "cache/embeddings")
+store_dtype = os.getenv("EMBEDDING_STORE_DTYPE", "float16")
+# 进程内向量索引目录，为空时不启用（Upsert / Search 接口返回 FAILED_PRECONDITION）
+index_dir = os.getenv("VECTOR_INDEX_DIR", "")
+# exact：分块精确扫描；ivf：向量数超过 VECTOR_INDEX_IVF_MIN 后按倒排桶近似检索
+index_mode = os.getenv("VECTOR_INDEX_MODE", "exact")
+index_nlist = int(os.getenv("VECTOR_INDEX_NLIST", "0"))
+index_nprobe = int(os.getenv("VECTOR_INDEX_NPROBE", "8"))
+index_ivf_min = int(os.getenv("VECTOR_INDEX_IVF_MIN", "20000"))
+
+
+def _done(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
 
-from utils.image_loader import get_image_smart
+
+def _collect(futures: list) -> list:
+    results = []
+    for future in futures:
+        if isinstance(future, Exception):
+            results.append(future)
+            continue
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
 
 
 class ChineseClipEmbedder:
-    def __init__(self):
-        self.model_name = "OFA-Sys/chinese-clip-vit-base-patch16"
-        print(f"🔄 Loading {self.model_name}...")
+    model_name = "OFA-Sys/chinese-clip-vit-base-patch16"
+
+    def __init__(self, pool=None):
+        self.processor = self._load_processor()
+        # 进程池模式：本进程只做预处理、批处理和查库，前向交给 pool 里的子进程
+        self.pool = pool
+
+        if pool is None:
+            logger.info("loading model", model=self.model_name)
+
+            self.device = "mps" if torch.backends.mps.is_available() else "cpu"
+            logger.info("using device", device=self.device)
+
+            self.model = self._load_model().to(self.device)
 
-        self.device = "mps" if torch.backends.mps.is_available() else "cpu"
-        print(f"Using device: {self.device}")
+            self.model.eval()
+            logger.info("model loaded", model=self.model_name)
+            projection_dim = self.model.config.projection_dim
+        else:
+            projection_dim = self._load_config().projection_dim
 
-        self.model = ChineseCLIPModel.from_pretrained(
-            self.model_name,
-            torch_dtype=torch.float16
-        ).to(self.device)
-        self.processor = ChineseCLIPProcessor.from_pretrained(self.model_name)
+        # 并发的单条请求在这里合并成一个批次再前向；进程池模式下每个子进程可以各有一个批次在途
+        in_flight = pool.size if pool is not None else 1
+        self.text_batcher = MicroBatcher("embed_text", self._forward_texts, max_batch_size, max_wait_ms, in_flight)
+        self.image_batcher = MicroBatcher("embed_image", self._forward_pixels, max_batch_size, max_wait_ms,
+                                          in_flight)
 
-        self.model.eval()
-        print(f"✅ {self.model_name} loaded.")
+        self.store = None
+        if store_dir:
+            self.store = EmbeddingStore(store_dir, self.model_name, projection_dim, store_dtype)
 
+        self.index = None
+        if index_dir:
+            self.index = VectorIndex(index_dir, self.model_name, projection_dim, store_dtype, index_mode,
+                                     index_nlist, index_nprobe, index_ivf_min)
 
-    def embed_image(self, image_input):
-        image = get_image_smart(image_input)
-        inputs = self.processor(images=[image], return_tensors="pt").to(self.device)
+    # 模型、处理器和配置的加载单独成方法，基准测试的桩模型只替换这几处，其余流程照常执行
+    def _load_processor(self):
+        return ChineseCLIPProcessor.from_pretrained(self.model_name)
+
+    def _load_model(self):
+        return ChineseCLIPModel.from_pretrained(self.model_name, torch_dtype=torch.float16)
+
+    def _load_config(self):
+        return ChineseCLIPConfig.from_pretrained(self.model_name)
+
+    def warmup(self):
+        """用假输入各跑一次文本和图片前向，不经过批处理器和向量库"""
+        self.embed_texts(["热身"])
+        self._embed_pixels([self._preprocess_image(Image.new("RGB", (224, 224), "white"))])
+
+    def _preprocess_image(self, image):
+        return self.processor(images=[image], return_tensors="pt")["pixel_values"]
+
+    def _embed_pixels(self, pixels: list):
+        pixel_values = torch.cat(pixels)
+        with stage("forward", self.model_name):
+            if self.pool is not None:
+                return self.pool.call("embed_pixel_values", pixel_values.numpy())
+            return self.embed_pixel_values(pixel_values)
+
+    def _pool_forward(self, method: str, *args) -> Future:
+        """提交给进程池后立即返回，不占住批处理线程；子进程算完后由批处理器的回调把结果交给等待者"""
+        start = time.perf_counter()
+        future = self.pool.submit(method, *args)
+        future.add_done_callback(
+            lambda _: stage_latency.labels("forward", self.model_name).observe(time.perf_counter() - start))
+        return future
+
+    def _forward_pixels(self, pixels: list):
+        if self.pool is not None:
+            return self._pool_forward("embed_pixel_values", torch.cat(pixels).numpy())
+        return self._embed_pixels(pixels)
+
+    def _forward_texts(self, texts: list[str]):
+        if self.pool is not None:
+            return self._pool_forward("embed_texts", texts)
+        return self.embed_texts(texts)
+
+    def embed_pixel_values(self, pixel_values):
+        pixel_values = torch.as_tensor(pixel_values).to(self.device)
 
         with torch.no_grad():
             with torch.autocast(device_type=self.device, dtype=torch.float16):
-                image_features = self.model.get_image_features(**inputs)
+                image_features = self.model.get_image_features(pixel_values=pixel_values)
                 image_embeddings = torch.nn.functional.normalize(image_features, p=2, dim=-1)
         return image_embeddings.cpu().numpy()
 
-    def embed_text(self, text: str):
-        if not isinstance(text, str):
-            raise ValueError("text must be a string")
+    def embed_images(self, images: list):
+        return self._embed_pixels([self._preprocess_image(image) for image in images])
 
-        inputs = self.processor(text=[text], return_tensors="pt").to(self.device)
+    def embed_texts(self, texts: list[str]):
+        if self.pool is not None:
+            with stage("forward", self.model_name):
+                return self.pool.call("embed_texts", texts)
+        inputs = self.processor(text=texts, padding=True, return_tensors="pt").to(self.device)
 
-        with torch.no_grad():
+        with torch.no_grad(), stage("forward", self.model_name):
             with torch.autocast(device_type=self.device, dtype=torch.float16):
                 text_features = self.model.get_text_features(**inputs)
                 text_embeddings = torch.nn.functional.normalize(text_features, p=2, dim=-1)
         return text_embeddings.cpu().numpy()
 
-embedding_service = ChineseClipEmbedder()
+    def _pixels(self, image_input, image=None):
+        return get_preprocessed(image_input, self.model_name, "clip", self._preprocess_image, image)
+
+    def _submit(self, batcher, key, make_input) -> Future:
+        """先查持久化向量库，未命中才进入批处理器，算完写回"""
+        if key is not None:
+            cached = self.store.get(key)
+            if cached is not None:
+                return _done(cached)
+
+        value = make_input()
+        deadlines.check("forward")
+        future = batcher.submit(value)
+        if key is not None:
+            future.add_done_callback(lambda f: f.exception() is None and self.store.put(key, f.result()))
+        return future
+
+    def _submit_image(self, image_input, image=None) -> Future:
+        key = None
+        # 只有拿得到原始字节（即传入 URL）时才能按内容寻址
+        if self.store is not None and isinstance(image_input, str):
+            key = self.store.image_key(get_image_digest(image_input))
+        return self._submit(self.image_batcher, key, lambda: self._pixels(image_input, image))
+
+    def _submit_text(self, text: str) -> Future:
+        key = self.store.text_key(text) if self.store is not None else None
+        return self._submit(self.text_batcher, key, lambda: text)
+
+    def embed_image(self, image_input, image=None):
+        return self._submit_image(image_input, image).result()[None, :]
+
+    def embed_text(self, text: str):
+        if not isinstance(text, str):
+            raise ValueError("text must be a string")
+        return self._submit_text(text).result()[None, :]
+
+    def embed_text_batch(self, texts: list[str]) -> list:
+        """批量接口：结果与输入一一对应，失败的位置放异常对象"""
+        futures = []
+        for text in texts:
+            if not isinstance(text, str) or not text:
+                futures.append(ValueError("text must be a non-empty string"))
+            else:
+                futures.append(self._submit_text(text))
+        return _collect(futures)
+
+    def embed_image_batch(self, image_inputs: list, images: list = None) -> list:
+        """批量接口：并发下载、查库和预处理后整体交给批处理器，失败的位置放异常对象"""
+        futures = map_concurrent(self._submit_image, image_inputs, images or [None] * len(image_inputs))
+        return _collect(futures)
+
+    def _require_index(self) -> VectorIndex:
+        if self.index is None:
+            raise VectorIndexDisabledError("vector index is disabled, set VECTOR_INDEX_DIR to enable it")
+        return self.index
+
+    def upsert_batch(self, ids: list, sources: list, images: list = None) -> list:
+        """
+        写入索引：sources 里每个元素是 ("image", url)、("text", text) 或 ("vector", 浮点列表)，
+        图片和文本照常走向量库和批处理器；结果与输入一一对应，成功的位置为 None，失败的位置放异常对象
+        """
+        index = self._require_index()
+
+        def submit(source, image):
+            kind, value = source
+            if kind == "image":
+                return self._submit_image(value, image)
+            if kind == "text" and value:
+                return self._submit_text(value)
+            if kind == "vector":
+                return _done(value)
+            raise ValueError("one of image_url, text or vector is required")
+
+        futures = map_concurrent(submit, sources, images or [None] * len(ids))
+        results = []
+        for item_id, vector in zip(ids, _collect(futures)):
+            if isinstance(vector, Exception):
+                results.append(vector)
+                continue
+            try:
+                index.upsert(item_id, vector)
+                results.append(None)
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def search_text(self, text: str, k: int = 10, exact: bool = False) -> list:
+        index = self._require_index()
+        return index.search(self.embed_text(text)[0], k, exact)
+
+    def search_image(self, image_input, image=None, k: int = 10, exact: bool = False) -> list:
+        index = self._require_index()
+        return index.search(self.embed_image(image_input, image)[0], k, exact)
+
 
 if __name__ == "__main__":
     embedder = ChineseClipEmbedder()
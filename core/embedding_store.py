@@ -0,0 +1,99 @@
+import hashlib
+import os
+import re
+import unicodedata
+from threading import Lock
+
+import numpy as np
+
+from core.mmap_rows import open_rows, read_log
+from utils.log import get_logger
+
+logger = get_logger("embedding_store")
+digest_size = 16
+
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).strip()
+
+
+class EmbeddingStore:
+    """
+    按内容寻址的持久化向量库。
+    - key：模型名 + 内容（规范化后的文本，或图片原始字节的 content_digest）的 blake2b 摘要
+    - 向量：定长存放在 mmap 文件里，第 i 行对应索引里的第 i 条记录，读取时直接返回 mmap 上的视图
+    - 索引：只追加的摘要日志，重启时顺序重放即可恢复 key -> 行号
+    """
+
+    def __init__(self, directory: str, model_name: str, dim: int, dtype: str = "float16",
+                 initial_capacity: int = 65536):
+        os.makedirs(directory, exist_ok=True)
+        self.model_name = model_name
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+
+        prefix = os.path.join(directory, re.sub(r"[^\w.-]+", "_", model_name))
+        self.vectors_path = f"{prefix}.{dim}.{self.dtype.name}.vec"
+        self.index_path = f"{prefix}.{dim}.{self.dtype.name}.idx"
+
+        self._lock = Lock()
+        self._index = {}
+        self._load_index()
+        self._index_file = open(self.index_path, "ab")
+
+        self._vectors = None
+        self._open_vectors(max(initial_capacity, len(self._index)))
+        logger.info("embedding store opened", path=self.vectors_path, vectors=len(self._index))
+
+    def _load_index(self):
+        data = read_log(self.index_path, digest_size)
+        for row in range(len(data) // digest_size):
+            self._index[data[row * digest_size:(row + 1) * digest_size]] = row
+
+    def _open_vectors(self, capacity: int):
+        self._vectors = open_rows(self.vectors_path, self.dtype, self.dim, capacity, self._vectors)
+
+    def _digest(self, kind: bytes, data: bytes) -> bytes:
+        h = hashlib.blake2b(digest_size=digest_size)
+        h.update(self.model_name.encode())
+        h.update(b"\0" + kind + b"\0")
+        h.update(data)
+        return h.digest()
+
+    def text_key(self, text: str) -> bytes:
+        return self._digest(b"text", normalize_text(text).encode())
+
+    def image_key(self, digest: bytes) -> bytes:
+        """digest 为 image_loader.content_digest(原始字节)，下载时已经算好，不必再拿原始字节"""
+        return self._digest(b"image", digest)
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key: bytes):
+        with self._lock:
+            row = self._index.get(key)
+            if row is None:
+                return None
+            return self._vectors[row]
+
+    def put(self, key: bytes, vector):
+        vector = np.asarray(vector, dtype=self.dtype).reshape(-1)
+        if vector.size != self.dim:
+            raise ValueError(f"expected a {self.dim}-dim vector, got {vector.size}")
+        with self._lock:
+            if key in self._index:
+                return
+            row = len(self._index)
+            if row >= self._vectors.shape[0]:
+                self._open_vectors(self._vectors.shape[0] * 2)
+            # 先写向量再写索引，索引里出现的行一定已经写入
+            self._vectors[row] = vector
+            self._index_file.write(key)
+            self._index_file.flush()
+            self._index[key] = row
+
+    def close(self):
+        with self._lock:
+            self._vectors.flush()
+            self._index_file.close()
@@ -0,0 +1,303 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from utils import deadlines
+from utils.lanes import LaneFullError
+
+_STREAM_END = object()
+
+
+class EngineFullError(LaneFullError):
+    """等待解码槽位的序列已达上限；继承 LaneFullError，服务端同样返回 RESOURCE_EXHAUSTED"""
+
+
+class GenerationRequest:
+    """
+    一条在途生成序列。既可以阻塞等待完整结果（result），也可以逐段迭代（for chunk in request），
+    或者在事件循环里按帧产出（async for frame in request.frames()）。
+    """
+
+    def __init__(self, inputs: dict, max_tokens: int, sampling: dict, stop=None):
+        self.inputs = inputs
+        self.max_tokens = max_tokens
+        self.sampling = sampling
+        # stop(已生成的文本) -> True 时提前结束
+        self.stop = stop
+        self.state = None
+        self.text = ""
+        self.tokens = 0
+        self.cancelled = False
+        self.finish_reason = None
+        self.submitted_at = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+
+        self._chunks = queue.Queue()
+        self._done = Future()
+        # 异步消费者挂上的唤醒函数，由引擎线程在有新内容时调用
+        self._wakeup = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def add_done_callback(self, fn):
+        """引擎结束这条序列（正常结束、停止、取消或出错）并释放后端资源之后调用 fn(request)，已结束时立即调用"""
+        self._done.add_done_callback(lambda _: fn(self))
+
+    def wait(self, timeout: float = None) -> bool:
+        """等引擎结束这条序列，不关心结果；超时返回 False"""
+        try:
+            self._done.exception(timeout)
+        except FutureTimeoutError:
+            return False
+        except Exception:
+            pass
+        return True
+
+    def emit(self, segment: str):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.tokens += 1
+        if segment:
+            self.text += segment
+            self._put(segment)
+
+    def close(self, reason: str, error: Exception = None):
+        if self._done.done():
+            return
+        self.finish_reason = reason
+        self.finished_at = time.perf_counter()
+        self._put(error if error is not None else _STREAM_END)
+        if error is not None:
+            self._done.set_exception(error)
+        else:
+            self._done.set_result(self.text)
+
+    def _put(self, chunk):
+        self._chunks.put(chunk)
+        wakeup = self._wakeup
+        if wakeup is not None:
+            wakeup()
+
+    def result(self, timeout: float = None) -> str:
+        return self._done.result(timeout)
+
+    def __iter__(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is _STREAM_END:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    async def frames(self, min_chars: int = 0, max_delay: float = 0.0):
+        """
+        在事件循环里按帧产出文本，不占用线程。两个参数都为 0 时有新内容就产出；
+        否则攒够 min_chars 个字符，或距本帧第一段超过 max_delay 秒再产出，减少消息数。
+        消费者写得慢时，期间生成的内容会合并进下一帧。
+        """
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self._wakeup = lambda: loop.call_soon_threadsafe(ready.set)
+        frame, frame_started = "", None
+        while True:
+            finished = False
+            while not finished:
+                try:
+                    chunk = self._chunks.get_nowait()
+                except queue.Empty:
+                    break
+                if chunk is _STREAM_END:
+                    finished = True
+                elif isinstance(chunk, Exception):
+                    raise chunk
+                else:
+                    if not frame:
+                        frame_started = loop.time()
+                    frame += chunk
+
+            if finished:
+                if frame:
+                    yield frame
+                return
+
+            timeout = None
+            if frame:
+                elapsed = loop.time() - frame_started
+                if ((not min_chars and not max_delay)
+                        or (min_chars and len(frame) >= min_chars)
+                        or (max_delay and elapsed >= max_delay)):
+                    yield frame
+                    frame = ""
+                    continue
+                if max_delay:
+                    timeout = max_delay - elapsed
+
+            try:
+                await asyncio.wait_for(ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            ready.clear()
+
+    def stats(self) -> dict:
+        """首 token 延迟与解码速度（首 token 之后的 token/s）"""
+        end = self.finished_at or time.perf_counter()
+        ttft = None if self.first_token_at is None else self.first_token_at - self.submitted_at
+        decode_time = None if self.first_token_at is None else end - self.first_token_at
+        return {
+            "tokens": self.tokens,
+            "ttft_ms": None if ttft is None else round(ttft * 1000, 1),
+            "tokens_per_sec": round((self.tokens - 1) / decode_time, 1) if decode_time else None,
+            "finish_reason": self.finish_reason,
+        }
+
+
+class GenerationBackend:
+    """
+    模型后端接口。引擎只在自己的线程里调用这些方法，后端不需要考虑线程安全。
+    """
+
+    def start(self, request: GenerationRequest):
+        """预填充 request.inputs，返回该序列的状态对象"""
+        raise NotImplementedError
+
+    def step(self, states: list) -> list:
+        """让每个在途序列前进一个 token，返回 [(新增文本, 是否遇到结束符), ...]，与 states 一一对应"""
+        raise NotImplementedError
+
+    def finish(self, state):
+        """序列结束（正常结束、提前停止或取消）后释放资源"""
+        pass
+
+
+class GenerationEngine:
+    """
+    连续批处理调度器：最多 max_concurrent 条序列同时在途，每生成一个 token 都会检查是否有新请求可以加入、
+    是否有序列已经结束，新请求不必等整批生成完。所有模型调用都发生在引擎线程里。
+    等待槽位的序列按提交方的优先级排队（交互式请求先于批量请求），最多 max_pending 条，满了 submit 抛 EngineFullError。
+    """
+
+    def __init__(self, backend: GenerationBackend, max_concurrent: int = 4, max_pending: int = 16):
+        self.backend = backend
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_pending = max(0, max_pending)
+        self._pending = {p: deque() for p in sorted(deadlines.priority_names.values())}
+        self._active = []
+        self._calls = deque()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="generation-engine", daemon=True)
+        self._thread.start()
+
+    @property
+    def active(self) -> int:
+        return len(self._active)
+
+    @property
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self._pending.values())
+
+    def submit(self, inputs: dict, max_tokens: int, stop=None, **sampling) -> GenerationRequest:
+        request = GenerationRequest(inputs, max_tokens, sampling, stop)
+        with self._cond:
+            # 还没被接纳的序列里，能在下一轮占到空闲槽位的不算排队
+            capacity = self.max_concurrent + self.max_pending
+            if self.pending + len(self._active) >= capacity:
+                # 已取消但还没轮到的序列不占名额
+                for queue in self._pending.values():
+                    for cancelled in [r for r in queue if r.cancelled]:
+                        queue.remove(cancelled)
+                        cancelled.close("cancelled")
+            pending = self.pending
+            if pending + len(self._active) >= capacity:
+                raise EngineFullError(f"generation engine is saturated "
+                                      f"({len(self._active)} decoding, {pending} pending)")
+            self._pending[deadlines.priority()].append(request)
+            self._cond.notify()
+        return request
+
+    def _pop_pending(self):
+        for queue in self._pending.values():
+            if queue:
+                return queue.popleft()
+        return None
+
+    def call(self, fn):
+        """在引擎线程的两个 token 之间执行 fn 并返回结果，用于需要独占模型的操作（例如预填充前缀缓存）"""
+        future = Future()
+        with self._cond:
+            self._calls.append((fn, future))
+            self._cond.notify()
+        return future.result()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self.pending and not self._active and not self._calls:
+                    self._cond.wait()
+                calls = list(self._calls)
+                self._calls.clear()
+                admitted = []
+                while len(self._active) + len(admitted) < self.max_concurrent:
+                    request = self._pop_pending()
+                    if request is None:
+                        break
+                    admitted.append(request)
+
+            for fn, future in calls:
+                try:
+                    future.set_result(fn())
+                except Exception as e:
+                    future.set_exception(e)
+
+            for request in admitted:
+                self._admit(request)
+
+            if self._active:
+                self._step()
+
+    def _admit(self, request: GenerationRequest):
+        if request.cancelled:
+            request.close("cancelled")
+            return
+        try:
+            request.state = self.backend.start(request)
+        except Exception as e:
+            request.close("error", e)
+            return
+        self._active.append(request)
+
+    def _step(self):
+        try:
+            results = self.backend.step([request.state for request in self._active])
+        except Exception as e:
+            for request in self._active:
+                self._finish(request, "error", e)
+            self._active = []
+            return
+
+        still_active = []
+        for request, (segment, eos) in zip(self._active, results):
+            request.emit(segment)
+            if request.cancelled:
+                self._finish(request, "cancelled")
+            elif eos:
+                self._finish(request, "stop")
+            elif request.stop is not None and request.stop(request.text):
+                self._finish(request, "stop_condition")
+            elif request.tokens >= request.max_tokens:
+                self._finish(request, "length")
+            else:
+                still_active.append(request)
+        self._active = still_active
+
+    def _finish(self, request: GenerationRequest, reason: str, error: Exception = None):
+        try:
+            self.backend.finish(request.state)
+        finally:
+            request.close(reason, error)
@@ -0,0 +1,107 @@
+import copy
+
+import mlx.core as mx
+
+from mlx_vlm.generate import generate_step
+
+from core.generation_engine import GenerationBackend
+from utils.log import get_logger
+
+logger = get_logger("mlx_backend")
+
+sampling_aliases = {"temp": "temperature"}
+sampling_keys = ("temperature", "top_p", "repetition_penalty")
+
+
+class _Sequence:
+    def __init__(self, tokens, detokenizer):
+        self.tokens = tokens
+        self.detokenizer = detokenizer
+        self.pending = None
+        self.rope_deltas = None
+
+
+class MlxVlmBackend(GenerationBackend):
+    """
+    mlx_vlm 后端。mlx_vlm 没有支持不等长序列的批量 KV 缓存，所以每个 step 依次让每条序列前进一个 token
+    （迭代级调度）：新请求在 token 边界加入，短请求不会被长请求整段挡住。
+    每条序列保存自己的 M-RoPE 偏移（rope_deltas 是模型上的全局属性），切换序列前恢复。
+    这个属性名随 mlx-vlm 版本变化（0.3.6 起改成了 _rope_deltas），requirements.txt 里固定了版本。
+    """
+
+    def __init__(self, model, processor):
+        self.model = model
+        self.processor = processor
+        self.eos_ids = self._eos_ids()
+        # 没有这个属性时切换序列不会恢复偏移，带图片的序列交替生成时位置编码会错
+        self.has_rope_deltas = hasattr(model.language_model, "rope_deltas")
+        if not self.has_rope_deltas:
+            logger.warning("language model has no rope_deltas, per-sequence M-RoPE offsets are not restored",
+                           model=type(model.language_model).__module__)
+
+    def _eos_ids(self) -> set:
+        tokenizer = self.processor.tokenizer
+        ids = set()
+        if isinstance(getattr(tokenizer, "eos_token_id", None), int):
+            ids.add(tokenizer.eos_token_id)
+        for token in ("<|im_end|>", "<|endoftext|>"):
+            token_id = tokenizer.convert_tokens_to_ids(token)
+            if isinstance(token_id, int) and token_id >= 0:
+                ids.add(token_id)
+        return ids
+
+    def _set_rope(self, rope_deltas):
+        if self.has_rope_deltas:
+            self.model.language_model.rope_deltas = rope_deltas
+
+    def start(self, request):
+        inputs = dict(request.inputs)
+        prompt = inputs.pop("prompt", None)
+        input_ids = inputs.pop("input_ids", None)
+        if input_ids is None:
+            input_ids = mx.array(self.processor.tokenizer.encode(prompt, add_special_tokens=False))[None]
+        pixel_values = inputs.pop("pixel_values", None)
+        mask = inputs.pop("mask", None)
+        if mask is None:
+            mask = mx.ones_like(input_ids)
+        if "prompt_cache" in inputs:
+            # 纯文本接在前缀缓存后面，M-RoPE 偏移为 0
+            self._set_rope(mx.zeros((1, 1), dtype=mx.int32))
+
+        sampling = {}
+        for key, value in request.sampling.items():
+            key = sampling_aliases.get(key, key)
+            if key in sampling_keys:
+                sampling[key] = value
+
+        tokens = generate_step(input_ids, self.model, pixel_values, mask,
+                               max_tokens=request.max_tokens, **sampling, **inputs)
+        detokenizer = copy.copy(self.processor.detokenizer)
+        detokenizer.reset()
+        sequence = _Sequence(tokens, detokenizer)
+        # 第一次 next 完成预填充并得到第一个 token，留到下一个 step 再交给引擎
+        sequence.pending = next(tokens, None)
+        sequence.rope_deltas = getattr(self.model.language_model, "rope_deltas", None)
+        return sequence
+
+    def step(self, states: list) -> list:
+        results = []
+        for sequence in states:
+            if sequence.pending is not None:
+                item, sequence.pending = sequence.pending, None
+            else:
+                self._set_rope(sequence.rope_deltas)
+                item = next(sequence.tokens, None)
+
+            token = None if item is None else int(item[0])
+            if token is None or token in self.eos_ids:
+                sequence.detokenizer.finalize()
+                results.append((sequence.detokenizer.last_segment, True))
+            else:
+                sequence.detokenizer.add_token(token)
+                results.append((sequence.detokenizer.last_segment, False))
+        return results
+
+    def finish(self, state):
+        if state is not None:
+            state.tokens.close()
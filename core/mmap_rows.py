@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+
+
+def open_rows(path: str, dtype, dim: int, capacity: int, previous=None) -> np.memmap:
+    """
+    把 path 映射成 (capacity, dim) 的定长行矩阵，文件不够大时先扩展（新增部分是稀疏的全 0）。
+    扩容时传入 previous，先把旧映射上的改动刷回磁盘。
+    """
+    dtype = np.dtype(dtype)
+    size = capacity * dim * dtype.itemsize
+    with open(path, "ab"):
+        pass
+    if os.path.getsize(path) < size:
+        os.truncate(path, size)
+    if previous is not None:
+        previous.flush()
+    return np.memmap(path, dtype=dtype, mode="r+", shape=(capacity, dim))
+
+
+def read_log(path: str, record_size: int = None) -> bytes:
+    """
+    读取只追加的日志，返回其中完整的记录。record_size 为定长记录的字节数，为 None 时按换行分隔。
+    上次写日志时进程中断留下的不完整尾记录会从文件里截掉。
+    """
+    if not os.path.exists(path):
+        return b""
+    with open(path, "rb") as f:
+        data = f.read()
+    if record_size is None:
+        end = data.rfind(b"\n") + 1
+    else:
+        end = len(data) // record_size * record_size
+    if end != len(data):
+        os.truncate(path, end)
+    return data[:end]
@@ -1,55 +1,249 @@
+import os
+import random
 import re
+import threading
 
 import numpy as np
-from paddleocr import PaddleOCR
+from PIL import Image, ImageDraw
 
-from utils.image_loader import get_image_smart
+from utils import deadlines
+from utils.image_loader import get_preprocessed, map_concurrent
+from utils.log import get_logger
+from utils.metrics import ocr_prefilter, ocr_text_score, stage
+
+logger = get_logger("ocr")
 
 min_score = 0.6
+# PaddleOCR 推理线程数，进程池模式下由工作进程按分到的核数设置
+cpu_threads = int(os.getenv("OCR_CPU_THREADS", "10"))
+# 方向分类只对倒置（180 度）的文字有用；图库里的文字方向基本都是正的，可以关掉省掉一次前向
+angle_cls = os.getenv("OCR_ANGLE_CLS", "1") == "1"
+# 识别模型每个批次的文本行数，批量接口会把多张图片的文本行拼在一起识别
+rec_batch_num = int(os.getenv("OCR_REC_BATCH", "16"))
+# 面积（像素）小于这个值的检测框当作噪点丢掉，丢完没有框的图片直接返回空结果；0 表示不过滤
+min_box_area = float(os.getenv("OCR_MIN_BOX_AREA", "0"))
+
+# 文字预筛：文字得分低于阈值的图片不跑 OCR，直接返回空结果；0 表示关闭。
+# 先把阈值设得很低、看 vision_ocr_text_score 的分布和漏检率，再逐步调高
+prefilter_threshold = float(os.getenv("OCR_PREFILTER_THRESHOLD", "0"))
+# 打分时把图片按步长抽样到长边约这么多像素
+prefilter_side = int(os.getenv("OCR_PREFILTER_SIDE", "640"))
+# 相邻像素灰度差超过这个值才算笔画边缘
+prefilter_contrast = int(os.getenv("OCR_PREFILTER_CONTRAST", "40"))
+prefilter_tile = 16
+# 被预筛跳过的图片按这个比例照常跑 OCR，识别出文字就记一次漏检
+prefilter_audit_rate = float(os.getenv("OCR_PREFILTER_AUDIT_RATE", "0.02"))
+
+# 至少包含一个汉字、字母或数字才算有效内容
+_content_pattern = re.compile(r'[\u4e00-\u9fa5a-zA-Z0-9]')
+
+
+def _box_areas(boxes: np.ndarray) -> np.ndarray:
+    """(N, 4, 2) 的四边形检测框按鞋带公式算面积"""
+    x, y = boxes[..., 0], boxes[..., 1]
+    return 0.5 * np.abs((x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y).sum(axis=1))
+
+
+def text_score(img_array: np.ndarray) -> float:
+    """
+    文字存在性的粗略打分：抽样后的灰度图上，统计每个 16x16 小块里横向、纵向强边缘的密度，
+    取两者较小值（文字笔画两个方向都有密集的高对比边缘，天空、墙面、虚化背景几乎没有），返回所有小块中的最大值。
+    只用 numpy，全图一次向量化计算，比一次文字检测前向便宜几个数量级。
+    """
+    h, w = img_array.shape[:2]
+    step = max(1, max(h, w) // prefilter_side)
+    sample = img_array[::step, ::step]
+    # 绿色通道近似亮度，省掉一次三通道求平均
+    gray = (sample[..., 1] if sample.ndim == 3 else sample).astype(np.int16)
+
+    rows, cols = (gray.shape[0] - 1) // prefilter_tile, (gray.shape[1] - 1) // prefilter_tile
+    if rows == 0 or cols == 0:
+        return 1.0
+    size_h, size_w = rows * prefilter_tile, cols * prefilter_tile
+    dx = np.abs(np.diff(gray, axis=1))[:size_h, :size_w] > prefilter_contrast
+    dy = np.abs(np.diff(gray, axis=0))[:size_h, :size_w] > prefilter_contrast
 
+    def tile_density(edges):
+        return edges.reshape(rows, prefilter_tile, cols, prefilter_tile).mean(axis=(1, 3))
 
-def _is_valid_content(text):
-    text = text.strip()
-    if not text:
-        return False
-    if len(text) == 1:
-        if not re.match(r'[\u4e00-\u9fa5a-zA-Z0-9]', text):
-            return False
-    if not re.search(r'[\u4e00-\u9fa5a-zA-Z0-9]', text):
-        return False
-    return True
+    return float(np.minimum(tile_density(dx), tile_density(dy)).max())
+
+
+def _clean_lines(rec_res: list) -> list:
+    """按置信度和内容过滤识别结果：先用 numpy 一次比掉低分行，剩下的行只跑一个预编译的正则"""
+    if not rec_res:
+        return []
+    scores = np.fromiter((score for _, score in rec_res), dtype=np.float32, count=len(rec_res))
+    return [rec_res[i][0] for i in np.flatnonzero(scores >= min_score) if _content_pattern.search(rec_res[i][0])]
 
 
 class OCRService:
-    def __init__(self):
-        print("🔄 Loading PaddleOCR...")
-        self.ocr = PaddleOCR(use_angle_cls=True, lang='ch', show_log=False)
-        print("✅ PaddleOCR loaded.")
-
-    def extract_text(self, image_url):
-        image = get_image_smart(image_url)
-        img_array = np.array(image)
-        result = self.ocr.ocr(img_array, cls=True)
-
-        if not result or result[0] is None:
-            return "", []
-
-        cleaned_lines = []
-
-        for line_data in result[0]:
-            text_info = line_data[1]
-            text = text_info[0]
-            score = text_info[1]
-            if score < min_score:
+    def __init__(self, pool=None):
+        # 进程池模式：本进程只下载和解码，识别交给 pool 里的子进程，也不必导入 paddle
+        self.pool = pool
+        self._predict_lock = threading.Lock()
+        if pool is None:
+            logger.info("loading model", model="paddleocr")
+            self._load_model()
+            logger.info("model loaded", model="paddleocr")
+
+    def _load_model(self):
+        """设置 self.ocr（用到其中的 text_detector / text_classifier / text_recognizer 三个预测器）和检测框的排序、裁剪函数"""
+        from paddleocr import PaddleOCR
+
+        self.ocr = PaddleOCR(use_angle_cls=angle_cls, lang='ch', show_log=False, cpu_threads=cpu_threads,
+                             rec_batch_num=rec_batch_num)
+        # paddleocr 导入时把自带的 tools 目录加进了 sys.path，检测框排序和裁剪直接复用它的实现
+        from tools.infer.predict_system import sorted_boxes
+        from tools.infer.utility import get_rotate_crop_image
+
+        self._sorted_boxes = sorted_boxes
+        self._crop = get_rotate_crop_image
+
+    def warmup(self):
+        """对一张画了文字的假图片跑一遍检测、方向分类和识别"""
+        image = Image.new("RGB", (320, 64), "white")
+        ImageDraw.Draw(image).text((10, 20), "Warmup 2024", fill="black")
+        self._ocr_array(np.array(image))
+
+    def _img_array(self, image_url, image=None):
+        return get_preprocessed(image_url, "paddleocr", "ocr", np.array, image)
+
+    def extract_text(self, image_url, image=None, cls: bool = None):
+        """cls=False 跳过方向分类，默认取 OCR_ANGLE_CLS"""
+        img_array = self._img_array(image_url, image)
+        score = self._screen(img_array)
+        if score is not None:
+            if random.random() >= prefilter_audit_rate:
+                return "", []
+            result = self._ocr_array(img_array, cls)
+            self._audit(image_url, score, result)
+            return result
+        return self._ocr_array(img_array, cls)
+
+    def _screen(self, img_array):
+        """预筛：需要跳过时返回文字得分，否则返回 None"""
+        if prefilter_threshold <= 0:
+            return None
+        with stage("prefilter", "paddleocr"):
+            score = text_score(img_array)
+        ocr_text_score.observe(score)
+        if score >= prefilter_threshold:
+            ocr_prefilter.labels("passed").inc()
+            return None
+        ocr_prefilter.labels("skipped").inc()
+        return score
+
+    @staticmethod
+    def _audit(image_url, score, result):
+        ocr_prefilter.labels("audited").inc()
+        if isinstance(result, tuple) and result[1]:
+            ocr_prefilter.labels("false_negative").inc()
+            logger.warning("prefilter false negative", url=image_url, score=round(score, 4),
+                           threshold=prefilter_threshold, lines=len(result[1]))
+
+    def extract_text_batch(self, image_inputs: list, images: list = None, cls: bool = None) -> list:
+        """批量接口：并发下载，结果与输入一一对应，失败的位置放异常对象"""
+        img_arrays = map_concurrent(self._img_array, image_inputs, images or [None] * len(image_inputs))
+        results = list(img_arrays)
+        # 预筛跳过的位置直接填空结果，抽中复核的照常识别
+        audits = {}
+        for i, img_array in enumerate(img_arrays):
+            if isinstance(img_array, Exception):
                 continue
-            if not _is_valid_content(text):
+            score = self._screen(img_array)
+            if score is None:
+                continue
+            if random.random() < prefilter_audit_rate:
+                audits[i] = score
+            else:
+                results[i] = ("", [])
+        indices = [i for i, r in enumerate(results) if isinstance(r, np.ndarray)]
+
+        if self.pool is not None:
+            for i, result in zip(indices, self._ocr_arrays_pooled([img_arrays[i] for i in indices], cls)):
+                results[i] = result
+        else:
+            self._ocr_batch(img_arrays, indices, results, cls)
+
+        for i, score in audits.items():
+            self._audit(image_inputs[i], score, results[i])
+        return results
+
+    def _ocr_batch(self, img_arrays: list, indices: list, results: list, cls: bool = None):
+        try:
+            for i, result in zip(indices, self._ocr_arrays([img_arrays[i] for i in indices], cls)):
+                results[i] = result
+        except Exception:
+            # 整批失败时逐张重试，只让真正出问题的图片报错
+            for i in indices:
+                try:
+                    results[i] = self._ocr_array(img_arrays[i], cls)
+                except Exception as e:
+                    results[i] = e
+
+    def _ocr_arrays_pooled(self, img_arrays: list, cls: bool = None) -> list:
+        # 整批同时分发，所有工作进程并行识别
+        futures = [a if isinstance(a, Exception) else self.pool.submit("_ocr_array", a, cls) for a in img_arrays]
+        results = []
+        for future in futures:
+            if isinstance(future, Exception):
+                results.append(future)
                 continue
-            cleaned_lines.append(text)
-        full_text = " ".join(cleaned_lines)
-        return full_text, cleaned_lines
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _ocr_array(self, img_array, cls: bool = None):
+        if self.pool is not None:
+            with stage("forward", "paddleocr"):
+                return self.pool.call("_ocr_array", img_array, cls)
+        return self._ocr_arrays([img_array], cls)[0]
+
+    def _ocr_arrays(self, img_arrays: list, cls: bool = None) -> list:
+        """
+        多张图片一起识别：检测逐张做，检测不到文字的图片到此为止；
+        其余图片的文本行裁剪出来拼成一个列表，方向分类和识别各跑一次，识别模型按 rec_batch_num 成批前向。
+        """
+        use_cls = angle_cls if cls is None else cls and angle_cls
+        crops, owners, results = [], [], [("", []) for _ in img_arrays]
+        deadlines.check("forward")
+
+        # 进程内模式下只有一组预测器，它们不是线程安全的：并发的请求在这里排队，下载和预筛仍然并行
+        with self._predict_lock:
+            with stage("forward", "paddleocr-det"):
+                for i, img_array in enumerate(img_arrays):
+                    dt_boxes, _ = self.ocr.text_detector(img_array)
+                    if dt_boxes is None or len(dt_boxes) == 0:
+                        continue
+                    if min_box_area > 0:
+                        dt_boxes = dt_boxes[_box_areas(dt_boxes) >= min_box_area]
+                    for box in self._sorted_boxes(dt_boxes):
+                        crops.append(self._crop(img_array, box.copy()))
+                        owners.append(i)
+
+            if not crops:
+                return results
+
+            deadlines.check("forward")
+            if use_cls:
+                with stage("forward", "paddleocr-cls"):
+                    crops, _, _ = self.ocr.text_classifier(crops)
+            with stage("forward", "paddleocr-rec"):
+                rec_res, _ = self.ocr.text_recognizer(crops)
 
+        with stage("postprocess", "paddleocr"):
+            per_image = [[] for _ in img_arrays]
+            for owner, res in zip(owners, rec_res):
+                per_image[owner].append(res)
+            for i, lines in enumerate(per_image):
+                if lines:
+                    cleaned_lines = _clean_lines(lines)
+                    results[i] = (" ".join(cleaned_lines), cleaned_lines)
+        return results
 
-ocr_service = OCRService()
 
 if __name__ == "__main__":
     service = OCRService()
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+
+import mlx.core as mx
+from mlx_vlm.models.cache import make_prompt_cache
+
+from utils.log import get_logger
+
+logger = get_logger("prefix_cache")
+
+
+class _Entry:
+    def __init__(self, cache, length: int):
+        self.cache = cache
+        self.length = length
+        self.lock = Lock()
+
+
+class PrefixCache:
+    """
+    纯文本提示词的前缀 KV 缓存：固定的指令 / few-shot 前缀只预填充一次，
+    之后每个请求只需要预填充与用户输入相关的后缀，生成结束后把缓存裁回前缀长度留给下一次使用。
+
+    带图片的提示词不走这里：Qwen2.5-VL 的视觉 token 使用 M-RoPE，位置要根据整段序列计算，
+    而且指令文本位于图片之后，前缀里没有值得缓存的内容。
+    最多保留 max_entries 个前缀（包括被禁用的），超出时淘汰最久未用的。
+    """
+
+    def __init__(self, model, processor, runner=None, max_entries: int = 8):
+        self.model = model
+        self.processor = processor
+        # 预填充需要独占模型，由 runner 放到生成引擎的线程里执行
+        self._run = runner or (lambda fn: fn())
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def _tokenize(self, text: str) -> list[int]:
+        return self.processor.tokenizer.encode(text, add_special_tokens=False)
+
+    def _entry(self, prefix: str, suffix: str):
+        with self._lock:
+            if prefix in self._entries:
+                self._entries.move_to_end(prefix)
+                return self._entries[prefix]
+
+            prefix_ids = self._tokenize(prefix)
+            # 前缀和后缀分开分词的结果必须与整体分词一致，否则缓存的 KV 对应的是另一串 token
+            if prefix_ids + self._tokenize(suffix) != self._tokenize(prefix + suffix):
+                logger.warning("prefix cache disabled: tokenization is not split-stable at the prefix boundary")
+                self._store(prefix, None)
+                return None
+
+            cache = self._run(lambda: self._prefill(prefix_ids))
+            logger.info("prefix cache built", tokens=len(prefix_ids))
+            entry = _Entry(cache, len(prefix_ids))
+            self._store(prefix, entry)
+            return entry
+
+    def _store(self, prefix: str, entry):
+        # 调用方持有 self._lock；被淘汰的条目如果正被某个请求使用，等它用完后随引用释放
+        self._entries[prefix] = entry
+        self._entries.move_to_end(prefix)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _prefill(self, prefix_ids: list[int]):
+        cache = make_prompt_cache(self.model.language_model)
+        # 纯文本序列的 M-RoPE 偏移恒为 0；上一次带图片的生成会留下非零的 rope_deltas
+        if hasattr(self.model.language_model, "rope_deltas"):
+            self.model.language_model.rope_deltas = mx.zeros((1, 1), dtype=mx.int32)
+        self.model.language_model(mx.array(prefix_ids)[None], cache=cache)
+        mx.eval([c.state for c in cache])
+        return cache
+
+    def disable(self, prefix: str):
+        with self._lock:
+            self._store(prefix, None)
+
+    @contextmanager
+    def use(self, prefix: str, suffix: str):
+        """
+        产出已包含前缀的 KV 缓存；缓存不可用或正被其他请求占用时产出 None，调用方走完整预填充。
+        """
+        entry = self._entry(prefix, suffix)
+        if entry is None or not entry.lock.acquire(blocking=False):
+            yield None
+            return
+        try:
+            yield entry.cache
+        finally:
+            for c in entry.cache:
+                c.trim(c.offset - entry.length)
+            entry.lock.release()
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import threading
+import time
+from importlib import import_module
+
+from core.worker_pool import WorkerPool
+from utils.log import get_logger
+
+logger = get_logger("registry")
+
+# 模型状态
+NOT_LOADED = "not_loaded"
+LOADING = "loading"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+DISABLED = "disabled"
+
+# 服务名 -> (模块, 类名)。模块在加载时才导入，不托管的服务连依赖都不会导入
+service_classes = {
+    "embedding": ("core.embedding_service", "ChineseClipEmbedder"),
+    "ocr": ("core.ocr_service", "OCRService"),
+    "caption": ("core.caption_service", "CaptionService"),
+}
+# 替换服务实现，例如基准测试换成桩模型：VISION_SERVICE_CLASSES="embedding=bench.stubs:StubEmbedder,..."
+for _item in filter(None, (part.strip() for part in os.getenv("VISION_SERVICE_CLASSES", "").split(","))):
+    _name, _, _target = _item.partition("=")
+    _module, _, _class = _target.partition(":")
+    if _name.strip() not in service_classes:
+        raise ValueError(f"Unknown service in VISION_SERVICE_CLASSES: {_name}")
+    service_classes[_name.strip()] = (_module.strip(), _class.strip())
+
+# 加载后先用假输入跑一遍 warmup() 再标记为 ready，首个真实请求不用承担初始化开销
+warmup_enabled = os.getenv("MODEL_WARMUP", "1") == "1"
+
+# 进程池模式：EMBED_WORKERS / OCR_WORKERS 大于 0 时模型放进这么多个子进程，
+# 每个子进程的计算线程数由 *_WORKER_THREADS 指定，默认平分 CPU 核数
+worker_counts = {
+    "embedding": int(os.getenv("EMBED_WORKERS", "0")),
+    "ocr": int(os.getenv("OCR_WORKERS", "0")),
+}
+worker_threads = {
+    "embedding": int(os.getenv("EMBED_WORKER_THREADS", "0")),
+    "ocr": int(os.getenv("OCR_WORKER_THREADS", "0")),
+}
+# 子进程额外的环境变量：向量库只由前端进程读写
+worker_env = {
+    "embedding": {"EMBEDDING_STORE_DIR": "", "VECTOR_INDEX_DIR": ""},
+}
+
+
+class ModelUnavailableError(Exception):
+    pass
+
+
+class _Slot:
+    def __init__(self, name: str, enabled: bool):
+        self.name = name
+        self.state = NOT_LOADED if enabled else DISABLED
+        self.instance = None
+        self.error = None
+        self.load_seconds = None
+        self.loaded = threading.Event()
+        self.lock = threading.Lock()
+
+
+class ModelRegistry:
+    """
+    模型注册表：服务在第一次使用时加载，或者由 preload 在后台线程里并行加载，各自有独立的状态。
+    VISION_SERVICES 指定本进程托管哪些服务（逗号分隔，默认全部），未托管的服务请求直接报不可用。
+    状态变化时通知 add_listener 注册的回调 (服务名, 新状态)，回调在加载线程里执行。
+    """
+
+    def __init__(self, services: list = None):
+        if services is None:
+            spec = os.getenv("VISION_SERVICES", "")
+            services = [s.strip() for s in spec.split(",") if s.strip()] or list(service_classes)
+        unknown = set(services) - set(service_classes)
+        if unknown:
+            raise ValueError(f"Unknown services in VISION_SERVICES: {', '.join(sorted(unknown))}")
+        self._slots = {name: _Slot(name, name in services) for name in service_classes}
+        self._listeners = []
+
+    @property
+    def services(self) -> list:
+        return [name for name, slot in self._slots.items() if slot.state != DISABLED]
+
+    def state(self, name: str) -> str:
+        return self._slots[name].state
+
+    def states(self) -> dict:
+        return {name: slot.state for name, slot in self._slots.items()}
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def _set_state(self, slot: _Slot, state: str):
+        slot.state = state
+        for callback in self._listeners:
+            try:
+                callback(slot.name, state)
+            except Exception as e:
+                logger.warning("registry listener failed", error=e)
+
+    def _load(self, slot: _Slot):
+        with slot.lock:
+            if slot.state != NOT_LOADED:
+                return
+            self._set_state(slot, LOADING)
+        module_name, class_name = service_classes[slot.name]
+        start = time.perf_counter()
+        try:
+            service_class = getattr(import_module(module_name), class_name)
+            workers = worker_counts.get(slot.name, 0)
+            if workers > 0:
+                # 子进程各自加载并预热，前端实例只负责分发
+                threads = worker_threads[slot.name] or max(1, (os.cpu_count() or 1) // workers)
+                pool = WorkerPool(slot.name, module_name, class_name, workers, threads,
+                                  worker_env.get(slot.name), warmup_enabled)
+                instance = service_class(pool=pool)
+            else:
+                instance = service_class()
+            if workers <= 0 and warmup_enabled and hasattr(instance, "warmup"):
+                self._set_state(slot, WARMING)
+                instance.warmup()
+            slot.instance = instance
+            slot.load_seconds = time.perf_counter() - start
+            logger.info("service ready", service=slot.name, seconds=round(slot.load_seconds, 1))
+            self._set_state(slot, READY)
+        except Exception as e:
+            slot.error = e
+            logger.error("service failed to load", service=slot.name, error=e, exc_info=True)
+            self._set_state(slot, FAILED)
+        finally:
+            slot.loaded.set()
+
+    def get(self, name: str):
+        """返回服务实例，未加载时在当前线程加载；正在由其他线程加载时等待其完成"""
+        slot = self._slots[name]
+        if slot.state == DISABLED:
+            raise ModelUnavailableError(f"{name} service is not hosted by this process")
+        if slot.state == NOT_LOADED:
+            self._load(slot)
+        slot.loaded.wait()
+        if slot.state != READY:
+            raise ModelUnavailableError(f"{name} service failed to load: {slot.error}")
+        return slot.instance
+
+    async def aget(self, name: str):
+        slot = self._slots[name]
+        if slot.state == READY:
+            return slot.instance
+        return await asyncio.to_thread(self.get, name)
+
+    def preload(self, names: list = None):
+        """在后台线程里并行加载，不阻塞调用方"""
+        for name in names or self.services:
+            slot = self._slots[name]
+            if slot.state == NOT_LOADED:
+                threading.Thread(target=self._load, args=(slot,), name=f"load-{name}", daemon=True).start()
+
+
+registry = ModelRegistry()
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from threading import Lock
+
+from cachetools import TLRUCache
+
+from utils.metrics import watch_cache
+
+# 各接口结果的有效期（秒），可用 RESULT_CACHE_TTLS="tags=86400,query_graph=600" 覆盖
+default_ttls = {
+    "name": 86400,
+    "tags": 86400,
+    "triples": 86400,
+    "analyze": 86400,
+    "query_graph": 3600,
+}
+
+
+def _parse_ttls(spec: str) -> dict:
+    ttls = dict(default_ttls)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        endpoint, _, seconds = item.partition("=")
+        ttls[endpoint.strip()] = float(seconds)
+    return ttls
+
+
+class ResultCache:
+    """
+    VLM 接口的结果缓存：内存中按 LRU 淘汰，每个接口有自己的 TTL；可选用 SQLite 持久化，重启后仍然命中。
+    key 由 (接口, 图片内容哈希或查询文本, 提示词, 采样参数) 计算，提示词或参数一改，旧结果自然失效。
+    """
+
+    def __init__(self, maxsize: int = 10000, ttls: dict = None, db_path: str = None):
+        self.ttls = ttls or dict(default_ttls)
+        self.hits = 0
+        self.misses = 0
+        self._memory = TLRUCache(maxsize=maxsize, ttu=lambda key, value, now: now + self.ttls.get(key[0], 0))
+        self._lock = Lock()
+        self._db = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            self._db.execute("DELETE FROM results WHERE expires < ?", (time.time(),))
+            self._db.commit()
+
+    @staticmethod
+    def make_key(endpoint: str, content: bytes, prompt: str, params: dict):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(content)
+        h.update(b"\0" + prompt.encode())
+        h.update(b"\0" + json.dumps(params, sort_keys=True).encode())
+        return endpoint, h.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is None and self._db is not None:
+                row = self._db.execute("SELECT value, expires FROM results WHERE key = ?",
+                                       (f"{key[0]}:{key[1]}",)).fetchone()
+                if row is not None and row[1] >= time.time():
+                    value = json.loads(row[0])
+                    self._memory[key] = value
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                                 (f"{key[0]}:{key[1]}", json.dumps(value, ensure_ascii=False),
+                                  time.time() + self.ttls.get(key[0], 0)))
+                self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._memory), "hits": self.hits, "misses": self.misses}
+
+
+def create_result_cache():
+    """RESULT_CACHE_ENABLED=1 时启用；RESULT_CACHE_DB 指定 SQLite 文件路径时同时落盘"""
+    if os.getenv("RESULT_CACHE_ENABLED", "0") != "1":
+        return None
+    cache = ResultCache(
+        maxsize=int(os.getenv("RESULT_CACHE_SIZE", "10000")),
+        ttls=_parse_ttls(os.getenv("RESULT_CACHE_TTLS", "")),
+        db_path=os.getenv("RESULT_CACHE_DB") or None,
+    )
+    watch_cache("result", cache.stats)
+    return cache
@@ -0,0 +1,100 @@
+class JsonStop:
+    """
+    生成 JSON 时的提前停止条件，交给生成引擎的 stop 使用。
+    逐段增量扫描已生成的文本（跳过字符串里的括号和转义），顶层数组 / 对象一闭合就停止；
+    max_items 限定顶层数组的元素个数，凑够了立即停止，不必等模型自己收尾。
+    prefix 是预填进提示词、模型不会再生成的开头（例如 "["），用来约束输出一开始就是 JSON。
+    """
+
+    def __init__(self, prefix: str = "", max_items: int = None):
+        self.prefix = prefix
+        self.max_items = max_items
+        self.closed_at = None
+        # 顶层数组每个完整元素的结束位置
+        self.item_ends = []
+
+        self._chars = []
+        self._fed = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._item_open = False
+        self._scan(prefix)
+
+    def __call__(self, generated: str) -> bool:
+        self._scan(generated[self._fed:])
+        self._fed = len(generated)
+        if self.closed_at is not None:
+            return True
+        return self.max_items is not None and self.items >= self.max_items
+
+    @property
+    def items(self) -> int:
+        return len(self.item_ends)
+
+    def _complete_item(self, end: int):
+        self.item_ends.append(end)
+        self._item_open = False
+
+    def _scan(self, chunk: str):
+        for ch in chunk:
+            i = len(self._chars)
+            self._chars.append(ch)
+            if self.closed_at is not None:
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._complete_item(i + 1)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    self._item_open = True
+            elif ch in "[{":
+                self._depth += 1
+                if self._depth == 2:
+                    self._item_open = True
+            elif ch in "]}":
+                if self._depth == 0:
+                    continue
+                self._depth -= 1
+                if self._depth == 1:
+                    self._complete_item(i + 1)
+                elif self._depth == 0:
+                    if self._item_open:
+                        self._complete_item(i)
+                    self.closed_at = i + 1
+            elif ch == "," and self._depth == 1:
+                if self._item_open:
+                    self._complete_item(i)
+            elif self._depth == 1 and not ch.isspace():
+                self._item_open = True
+
+    def repair(self) -> str:
+        """
+        返回截断修复后的完整 JSON 文本（含 prefix）：已闭合的截到闭合处；
+        因 max_items 或 max_tokens 停下的数组截到最后一个完整元素并补上 "]"。
+        """
+        text = "".join(self._chars)
+        if not text.lstrip().startswith("["):
+            return text[:self.closed_at]
+        # 一段文本可能一次带出多个元素，超出 max_items 的部分丢掉
+        ends = self.item_ends[:self.max_items]
+        if self.closed_at is not None and len(ends) == self.items:
+            return text[:self.closed_at]
+        if ends:
+            return text[:ends[-1]] + "]"
+        return text
+
+
+def first_line_stop(generated: str) -> bool:
+    """单行输出（例如标题）写完第一行就停止"""
+    return "\n" in generated.lstrip()
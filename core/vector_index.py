@@ -0,0 +1,212 @@
+import os
+import re
+import threading
+from threading import Lock
+
+import numpy as np
+
+from core.mmap_rows import open_rows, read_log
+from utils.log import get_logger
+from utils.metrics import stage
+
+logger = get_logger("vector_index")
+
+# 精确扫描时每次参与矩阵乘的行数，控制临时 float32 块的内存（512 维时每块约 8MB，并发检索也不会占用太多内存）
+block_rows = 4096
+kmeans_iterations = 10
+# 每个聚类中心抽多少条样本参与训练
+samples_per_list = 256
+
+
+class VectorIndexDisabledError(Exception):
+    pass
+
+
+def _top_k(scores: np.ndarray, rows: np.ndarray, k: int):
+    if len(scores) > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+        return scores[keep], rows[keep]
+    return scores, rows
+
+
+class VectorIndex:
+    """
+    进程内的向量索引，按内积（归一化向量即余弦相似度）检索 top-k。
+    - 向量：定长存放在 mmap 文件里，第 i 行对应 id 日志里的第 i 条
+    - id：只追加的日志，每行一个 id，重启时顺序重放恢复 id -> 行号；已有 id 再次写入时原地覆盖向量
+    - 检索：exact 按块做矩阵乘精确扫描；ivf 用球面 k-means 把向量分到 nlist 个桶，只扫描离查询最近的 nprobe 个桶，
+      训练后新增或覆盖的行不在桶里，检索时总是精确扫描这些行，积累到一定比例后后台重新训练
+    """
+
+    def __init__(self, directory: str, name: str, dim: int, dtype: str = "float16", mode: str = "exact",
+                 nlist: int = 0, nprobe: int = 8, ivf_min_vectors: int = 20000, initial_capacity: int = 65536):
+        if mode not in ("exact", "ivf"):
+            raise ValueError(f"Unknown vector index mode: {mode}")
+        os.makedirs(directory, exist_ok=True)
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.mode = mode
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.ivf_min_vectors = ivf_min_vectors
+
+        prefix = os.path.join(directory, re.sub(r"[^\w.-]+", "_", name))
+        self.vectors_path = f"{prefix}.{dim}.{self.dtype.name}.vec"
+        self.ids_path = f"{prefix}.{dim}.{self.dtype.name}.ids"
+
+        self._lock = Lock()
+        self._ids = []
+        self._rows = {}
+        self._load_ids()
+        self._ids_file = open(self.ids_path, "a", encoding="utf-8")
+
+        self._vectors = None
+        self._open_vectors(max(initial_capacity, len(self._ids)))
+
+        # (centroids, 按桶排好的行号, 各桶在其中的起止位置, 训练时的行数)
+        self._ivf = None
+        self._dirty = set()
+        self._training = False
+        # 上次训练失败时的行数；失败后要等行数再增长到下一个阈值才重试，避免失败后立刻反复重训
+        self._failed_at = None
+        logger.info("vector index opened", path=self.vectors_path, vectors=len(self._ids), mode=mode)
+        self._maybe_train()
+
+    def _load_ids(self):
+        for row, item_id in enumerate(read_log(self.ids_path).decode("utf-8").splitlines()):
+            self._ids.append(item_id)
+            self._rows[item_id] = row
+
+    def _open_vectors(self, capacity: int):
+        self._vectors = open_rows(self.vectors_path, self.dtype, self.dim, capacity, self._vectors)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def upsert(self, item_id: str, vector):
+        if not item_id or "\n" in item_id:
+            raise ValueError("id must be a non-empty single-line string")
+        vector = np.asarray(vector, dtype=self.dtype).reshape(-1)
+        if vector.size != self.dim:
+            raise ValueError(f"expected a {self.dim}-dim vector, got {vector.size}")
+        with self._lock:
+            row = self._rows.get(item_id)
+            if row is not None:
+                self._vectors[row] = vector
+                if self._ivf is not None and row < self._ivf[3]:
+                    self._dirty.add(row)
+                return
+            row = len(self._ids)
+            if row >= self._vectors.shape[0]:
+                self._open_vectors(self._vectors.shape[0] * 2)
+            # 先写向量再写日志，日志里出现的行一定已经写入
+            self._vectors[row] = vector
+            self._ids_file.write(item_id + "\n")
+            self._ids_file.flush()
+            self._ids.append(item_id)
+            self._rows[item_id] = row
+        self._maybe_train()
+
+    def search(self, query, k: int = 10, exact: bool = False) -> list:
+        """返回按相似度从高到低排列的 [(id, score)]"""
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        if query.size != self.dim:
+            raise ValueError(f"expected a {self.dim}-dim query, got {query.size}")
+        with self._lock:
+            vectors, count, ivf, dirty = self._vectors, len(self._ids), self._ivf, list(self._dirty)
+        if count == 0 or k <= 0:
+            return []
+
+        with stage("search", "vector_index"):
+            if exact or ivf is None:
+                scores, rows = self._scan(vectors, query, count, k)
+            else:
+                scores, rows = self._probe(vectors, query, count, k, ivf, dirty)
+            order = np.argsort(-scores)
+        return [(self._ids[rows[i]], float(scores[i])) for i in order]
+
+    def _scan(self, vectors, query, count, k):
+        best_scores, best_rows = np.empty(0, np.float32), np.empty(0, np.int64)
+        for start in range(0, count, block_rows):
+            stop = min(start + block_rows, count)
+            scores = np.asarray(vectors[start:stop], dtype=np.float32) @ query
+            scores, rows = _top_k(scores, np.arange(start, stop), k)
+            best_scores, best_rows = _top_k(np.concatenate([best_scores, scores]),
+                                            np.concatenate([best_rows, rows]), k)
+        return best_scores, best_rows
+
+    def _probe(self, vectors, query, count, k, ivf, dirty):
+        centroids, order, bounds, trained = ivf
+        probes = np.argsort(-(centroids @ query))[:self.nprobe]
+        candidates = [order[bounds[c]:bounds[c + 1]] for c in probes]
+        # 训练之后追加和覆盖的行不在桶里，逐行精确比较
+        candidates.append(np.arange(trained, count))
+        candidates.append(np.asarray(dirty, dtype=np.int64))
+        rows = np.unique(np.concatenate(candidates))
+        scores = np.asarray(vectors[rows], dtype=np.float32) @ query
+        return _top_k(scores, rows, k)
+
+    def _maybe_train(self):
+        if self.mode != "ivf":
+            return
+        with self._lock:
+            count = len(self._ids)
+            if self._training or count < self.ivf_min_vectors:
+                return
+            if self._failed_at is not None and count < self._failed_at * 1.2:
+                return
+            # 训练后新增或覆盖的行超过 20% 时重新训练
+            if self._ivf is not None and (count - self._ivf[3]) + len(self._dirty) < 0.2 * self._ivf[3]:
+                return
+            self._training = True
+            dirty = set(self._dirty)
+        threading.Thread(target=self._train, args=(count, dirty), name="vector-index-train", daemon=True).start()
+
+    def _train(self, count: int, dirty: set):
+        try:
+            with stage("train", "vector_index"):
+                ivf = self._build_ivf(count)
+            with self._lock:
+                self._ivf = ivf
+                self._failed_at = None
+                # 训练期间又被覆盖的行可能没按新值分桶，继续当作脏行
+                self._dirty -= dirty
+            logger.info("ivf index trained", vectors=count, lists=len(ivf[0]))
+        except Exception as e:
+            with self._lock:
+                self._failed_at = count
+            logger.error("ivf training failed", vectors=count, error=e, exc_info=True)
+        finally:
+            self._training = False
+        self._maybe_train()
+
+    def _build_ivf(self, count: int):
+        vectors = self._vectors
+        nlist = self.nlist or max(1, int(np.sqrt(count)))
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(count, min(count, nlist * samples_per_list), replace=False))
+        sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+        # 中心从样本里不放回地抽取，桶数不能超过样本数
+        nlist = min(nlist, len(sample))
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+
+        # 球面 k-means：按内积分配，中心取均值后重新归一化，空桶保留上一轮的中心
+        for _ in range(kmeans_iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        assign = np.empty(count, dtype=np.int32)
+        for start in range(0, count, block_rows):
+            stop = min(start + block_rows, count)
+            assign[start:stop] = np.argmax(np.asarray(vectors[start:stop], dtype=np.float32) @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(nlist + 1))
+        return centroids, order, bounds, count
+
+    def close(self):
+        with self._lock:
+            self._vectors.flush()
+            self._ids_file.close()
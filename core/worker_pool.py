@@ -0,0 +1,319 @@
+import itertools
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from importlib import import_module
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from utils.log import get_logger
+
+logger = get_logger("worker_pool")
+
+# 检查子进程是否存活的间隔（秒）
+liveness_interval = 1.0
+# 子进程加载模型失败后按指数退避重启，连续失败这么多次后放弃该槽位
+restart_backoff = 1.0
+max_restart_backoff = 60.0
+max_load_failures = 5
+
+# 子进程状态：ready 可接任务；loading 正在加载模型；backoff 等待重启；failed 已放弃
+READY, LOADING, BACKOFF, FAILED = "ready", "loading", "backoff", "failed"
+
+
+class _SharedArray:
+    """共享内存里的 numpy 数组句柄，跨进程只序列化名字、形状和类型"""
+
+    def __init__(self, name: str, shape: tuple, dtype: str):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+
+def _share(array: np.ndarray):
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+    return shm, _SharedArray(shm.name, array.shape, array.dtype.str)
+
+
+def _attach(handle: _SharedArray):
+    shm = shared_memory.SharedMemory(name=handle.name)
+    return shm, np.ndarray(handle.shape, np.dtype(handle.dtype), buffer=shm.buf)
+
+
+def _close(shm, unlink: bool = False):
+    try:
+        shm.close()
+    except BufferError:
+        # 还有视图引用着映射（例如异常回溯里的帧），等它们被回收时再释放
+        pass
+    if unlink:
+        shm.unlink()
+
+
+def _picklable(error: Exception) -> Exception:
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(repr(error))
+
+
+def _worker_main(worker_id: int, module_name: str, class_name: str, threads: int, env: dict, warmup: bool,
+                 tasks, results):
+    # results 是这个进程独占的管道写端，send 在当前线程里同步写完，进程随时退出也不会留下别人要等的锁
+    # 必须在导入 torch / paddle 之前设置，否则每个进程都会按整机核数开线程
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "OCR_CPU_THREADS"):
+        os.environ[var] = str(threads)
+    os.environ.update(env)
+
+    try:
+        service = getattr(import_module(module_name), class_name)()
+        if "torch" in sys.modules:
+            sys.modules["torch"].set_num_threads(threads)
+        if warmup and hasattr(service, "warmup"):
+            service.warmup()
+    except Exception as e:
+        results.send((None, worker_id, _picklable(e)))
+        return
+    results.send((None, worker_id, None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, method, args = task
+        attached = []
+        try:
+            call_args = []
+            for arg in args:
+                if isinstance(arg, _SharedArray):
+                    shm, arg = _attach(arg)
+                    attached.append(shm)
+                call_args.append(arg)
+            result = getattr(service, method)(*call_args)
+            del call_args
+            if isinstance(result, np.ndarray):
+                shm, result = _share(result)
+                _close(shm)
+            results.send((task_id, True, result))
+        except Exception as e:
+            results.send((task_id, False, _picklable(e)))
+        finally:
+            for shm in attached:
+                _close(shm)
+
+
+class WorkerPool:
+    """
+    进程池：workers 个子进程各自加载一份模型，每个进程限定 threads 个计算线程。
+    每个子进程有自己的任务队列和结果管道，任务派给已就绪且在途任务最少的进程，这样子进程意外退出时可以准确知道哪些任务随它丢失；
+    结果不走共享的 multiprocessing.Queue，是因为一个进程在写队列时退出会带走队列的写锁，其余进程从此再也交不回结果。
+    退出的子进程会被拉起，重新加载完成前不接新任务；加载失败按指数退避重试，连续失败 max_load_failures 次后放弃。
+    numpy 数组参数和返回值（图片像素、向量）通过共享内存传递，队列里只有句柄和少量元数据；
+    共享内存统一由前端进程在拿到结果后释放。
+    """
+
+    def __init__(self, name: str, module_name: str, class_name: str, workers: int, threads: int,
+                 env: dict = None, warmup: bool = True):
+        self.name = name
+        self._args = (module_name, class_name, threads, env or {}, warmup)
+        self._ctx = mp.get_context("spawn")
+        self._queues = [self._ctx.Queue() for _ in range(workers)]
+        # 结果管道的读端，只在 _listen 线程里读写；None 表示对端已经关闭，等重启时换新管道
+        self._readers = [None] * workers
+        self._closed = False
+        self._load = [0] * workers
+        self._states = [LOADING] * workers
+        self._failures = [0] * workers
+        self._respawn_at = [0.0] * workers
+        # task_id -> (future, 共享内存, 子进程编号)
+        self._pending = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._processes = [self._start(i) for i in range(workers)]
+
+        # 等所有子进程加载（和预热）完成
+        errors = []
+        for worker_id, reader in enumerate(self._readers):
+            try:
+                _, _, error = reader.recv()
+            except EOFError:
+                error = f"exited with code {self._processes[worker_id].exitcode}"
+            if error is not None:
+                errors.append(f"worker {worker_id}: {error}")
+            else:
+                self._states[worker_id] = READY
+        if errors:
+            self.close()
+            raise RuntimeError(f"{name} worker pool failed to start: {'; '.join(errors)}")
+        logger.info("worker pool ready", pool=name, processes=workers, threads=threads)
+
+        threading.Thread(target=self._listen, name=f"pool-{name}-results", daemon=True).start()
+
+    def _start(self, worker_id: int):
+        reader, writer = self._ctx.Pipe(duplex=False)
+        process = self._ctx.Process(target=_worker_main, name=f"{self.name}-worker-{worker_id}", daemon=True,
+                                    args=(worker_id, *self._args, self._queues[worker_id], writer))
+        process.start()
+        # 只有子进程持有写端，它退出后读端会读到 EOF，而不是永远等一条写了一半的消息
+        writer.close()
+        if self._readers[worker_id] is not None:
+            self._readers[worker_id].close()
+        self._readers[worker_id] = reader
+        return process
+
+    @property
+    def size(self) -> int:
+        return len(self._processes)
+
+    def _pick_worker(self):
+        """已就绪的进程里在途任务最少的一个；都没就绪时才排到正在重启的进程上，全部放弃时返回 None"""
+        for states in ((READY,), (LOADING, BACKOFF)):
+            candidates = [i for i, state in enumerate(self._states) if state in states]
+            if candidates:
+                return min(candidates, key=self._load.__getitem__)
+        return None
+
+    def submit(self, method: str, *args) -> Future:
+        future = Future()
+        shared = []
+        call_args = []
+        for arg in args:
+            if isinstance(arg, np.ndarray):
+                shm, arg = _share(arg)
+                shared.append(shm)
+            call_args.append(arg)
+
+        task_id = next(self._ids)
+        with self._lock:
+            worker = self._pick_worker()
+            if worker is not None:
+                self._load[worker] += 1
+                self._pending[task_id] = (future, shared, worker)
+                tasks = self._queues[worker]
+        if worker is None:
+            for shm in shared:
+                _close(shm, unlink=True)
+            future.set_exception(RuntimeError(f"{self.name} worker pool has no live workers"))
+            return future
+        tasks.put((task_id, method, call_args))
+        return future
+
+    def call(self, method: str, *args):
+        return self.submit(method, *args).result()
+
+    def _listen(self):
+        next_check = time.monotonic() + liveness_interval
+        while not self._closed:
+            # 存活检查按时间触发：结果管道一直有消息时也要发现崩溃的子进程
+            if time.monotonic() >= next_check:
+                self._check_workers()
+                next_check = time.monotonic() + liveness_interval
+            readers = {reader: i for i, reader in enumerate(self._readers) if reader is not None}
+            for reader in wait(list(readers), timeout=liveness_interval):
+                self._receive(readers[reader])
+
+    def _receive(self, worker_id: int):
+        reader = self._readers[worker_id]
+        try:
+            task_id, ok, result = reader.recv()
+        except (EOFError, OSError):
+            # 子进程已经退出，由 _check_workers 处理它丢下的任务
+            reader.close()
+            self._readers[worker_id] = None
+            return
+
+        if task_id is None:
+            # 重启的子进程加载完成（或失败）的通知；失败的进程随后退出，由 _check_workers 安排重试
+            if result is not None:
+                logger.error("restarted worker failed to load", pool=self.name, worker=ok, error=result)
+            else:
+                with self._lock:
+                    self._states[ok] = READY
+                    self._failures[ok] = 0
+                logger.info("restarted worker ready", pool=self.name, worker=ok)
+            return
+
+        if ok and isinstance(result, _SharedArray):
+            shm, view = _attach(result)
+            result = view.copy()
+            del view
+            _close(shm, unlink=True)
+
+        with self._lock:
+            entry = self._pending.pop(task_id, None)
+            if entry is not None:
+                self._load[entry[2]] -= 1
+        if entry is None:
+            return
+        future, shared, _ = entry
+        for shm in shared:
+            _close(shm, unlink=True)
+        if ok:
+            future.set_result(result)
+        else:
+            future.set_exception(result)
+
+    def _check_workers(self):
+        """
+        子进程意外退出时，派给它的任务（执行中的和还在它队列里的）以失败结束，其余任务不受影响；
+        就绪后才退出的立即重启，加载阶段就退出的按退避时间重启，连续失败太多次后不再重启。
+        """
+        now = time.monotonic()
+        for i, process in enumerate(self._processes):
+            alive = process.is_alive()
+            if not alive:
+                # 退出前已经写进管道的结果照常交付，剩下的才算丢失
+                while self._readers[i] is not None and self._readers[i].poll():
+                    self._receive(i)
+            lost = {}
+            with self._lock:
+                state = self._states[i]
+                if state in (READY, LOADING) and not alive:
+                    lost = {task_id: entry for task_id, entry in self._pending.items() if entry[2] == i}
+                    for task_id in lost:
+                        del self._pending[task_id]
+                    self._load[i] = 0
+                    self._failures[i] = self._failures[i] + 1 if state == LOADING else 0
+                    if self._failures[i] >= max_load_failures:
+                        self._states[i] = FAILED
+                    else:
+                        delay = restart_backoff * 2 ** (self._failures[i] - 1) if self._failures[i] else 0.0
+                        self._respawn_at[i] = now + min(delay, max_restart_backoff)
+                        self._states[i] = BACKOFF
+                    # 换新队列：旧进程没取走的任务随它一起作废
+                    self._queues[i] = self._ctx.Queue()
+                    state = self._states[i]
+                    if state == FAILED:
+                        logger.error("worker keeps failing to load, giving up", pool=self.name, worker=i,
+                                     failures=self._failures[i])
+                    else:
+                        logger.error("worker exited, restarting", pool=self.name, worker=i, exitcode=process.exitcode,
+                                     delay=round(self._respawn_at[i] - now, 1))
+                restart = state == BACKOFF and now >= self._respawn_at[i]
+                if restart:
+                    self._states[i] = LOADING
+
+            for future, shared, _ in lost.values():
+                for shm in shared:
+                    _close(shm, unlink=True)
+                future.set_exception(RuntimeError(f"{self.name} worker {i} exited"))
+            # 拉起进程（导入模型库）可能要几秒，不能占着锁
+            if restart:
+                self._processes[i] = self._start(i)
+
+    def close(self):
+        self._closed = True
+        for tasks in self._queues:
+            tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
@@ -1,122 +1,507 @@
+import asyncio
+import contextlib
+import functools
+import inspect
+import os
 import time
-from concurrent import futures
 
 import grpc
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
 
 import vision_pb2
 import vision_pb2_grpc
-from core.caption_service import caption_service
-from core.embedding_service import embedding_service
-from core.ocr_service import ocr_service
+from core.registry import NOT_LOADED, READY, ModelUnavailableError, registry, worker_counts
+from core.vector_index import VectorIndexDisabledError
+from utils import deadlines, metrics
+from utils.embedding_codec import encode_embedding
+from utils.image_loader import close_http_session, get_image_smart_async, get_images_smart_async
+from utils.lanes import Lane, LaneFullError
+from utils.log import get_logger
 
+logger = get_logger("server")
 
-class VisionServer(vision_pb2_grpc.VisionServiceServicer):
+# 每个模型家族一条独立通道，互不阻塞：(并发数, 等待队列长度)
+embedding_lane = Lane("embedding",
+                      int(os.getenv("EMBED_LANE_CONCURRENCY", "32")),
+                      int(os.getenv("EMBED_LANE_QUEUE", "128")))
+# 进程池模式下 OCR 可以并行到工作进程数；进程内模式只有一组 PaddleOCR 预测器，不是线程安全的，只能串行
+ocr_lane = Lane("ocr",
+                int(os.getenv("OCR_LANE_CONCURRENCY", str(max(1, worker_counts["ocr"])))),
+                int(os.getenv("OCR_LANE_QUEUE", "16")))
+caption_lane = Lane("caption",
+                    int(os.getenv("CAPTION_LANE_CONCURRENCY", "4")),
+                    int(os.getenv("CAPTION_LANE_QUEUE", "4")))
+lanes = [embedding_lane, ocr_lane, caption_lane]
+for _lane in lanes:
+    metrics.watch_lane(_lane)
 
-    def EmbedText(self, request, context):
-        try:
-            print(f"📝 Request EmbedText: {request.text}")
-            vector = embedding_service.embed_text(request.text)
-            return vision_pb2.EmbeddingResponse(vector=vector[0].tolist(), dim=vector[0].size)
-        except Exception as e:
-            print(f"Error: {e}")
-            context.set_code(grpc.StatusCode.INTERNAL)
-            context.set_details(str(e))
-            return vision_pb2.EmbeddingResponse()
 
-    def EmbedImage(self, request, context):
-        try:
-            print(f"🖼️ Request EmbedImage: {request.url}")
-            vector = embedding_service.embed_image(request.url)
-            return vision_pb2.EmbeddingResponse(vector=vector[0].tolist(), dim=vector[0].size)
-        except Exception as e:
-            print(f"Error: {e}")
-            context.set_code(grpc.StatusCode.INTERNAL)
-            context.set_details(str(e))
-            return vision_pb2.EmbeddingResponse()
+def _engine_stat(attr: str):
+    # 生成服务没加载时不输出，而不是报 0 个序列
+    if registry.state("caption") != READY:
+        return None
+    return getattr(registry.get("caption").engine, attr)
 
-    def GenerateFileName(self, request, context):
-        try:
-            print(f"🔍 Request gen file name: {request.image_url}")
-            name = caption_service.generate_name(request.image_url)
-            return vision_pb2.GenFileNameResponse(name=name)
-        except Exception as e:
-            print(f"Error: {e}")
-            context.set_code(grpc.StatusCode.INTERNAL)
-            context.set_details(str(e))
-            return vision_pb2.GenFileNameResponse()
 
-    def GenerateTags(self, request, context):
-        try:
-            print(f"🔍 Request gen tag: {request.image_url}")
-            name = caption_service.generate_tags(request.image_url)
-            return vision_pb2.GenTagsResponse(tag=name)
-        except Exception as e:
-            print(f"Error: {e}")
-            context.set_code(grpc.StatusCode.INTERNAL)
-            context.set_details(str(e))
-            return vision_pb2.GenTagsResponse()
+metrics.watch_gauge("vision_generation_active", "Sequences being decoded", lambda: _engine_stat("active"))
+metrics.watch_gauge("vision_generation_pending", "Sequences waiting for a decode slot", lambda: _engine_stat("pending"))
+
+# GenerateCaption 的分帧：攒够字符数或等够毫秒数再发一帧，都为 0 时逐段发送
+stream_frame_chars = int(os.getenv("CAPTION_STREAM_FRAME_CHARS", "0"))
+stream_frame_ms = float(os.getenv("CAPTION_STREAM_FRAME_MS", "0"))
+
+
+def _item_status(error=None):
+    if error is None:
+        return vision_pb2.ItemStatus(code=grpc.StatusCode.OK.value[0])
+    return vision_pb2.ItemStatus(code=_error_code(error).value[0], message=str(error))
+
+
+def _embedding_response(vector, fmt=vision_pb2.VECTOR):
+    vector = vector.reshape(-1)
+    if fmt == vision_pb2.VECTOR:
+        return vision_pb2.EmbeddingResponse(vector=vector.tolist(), dim=vector.size)
+    # 紧凑格式直接从 numpy 缓冲区编码，不经过 Python float 列表
+    data, scale = encode_embedding(vector, vision_pb2.EmbeddingFormat.Name(fmt).lower())
+    return vision_pb2.EmbeddingResponse(data=data, dim=vector.size, format=fmt, scale=scale)
+
+
+def _embedding_batch_response(results, fmt=vision_pb2.VECTOR):
+    items = []
+    for result in results:
+        if isinstance(result, Exception):
+            items.append(vision_pb2.EmbeddingResult(status=_item_status(result)))
+        else:
+            embedding = _embedding_response(result, fmt)
+            items.append(vision_pb2.EmbeddingResult(embedding=embedding, status=_item_status()))
+    return vision_pb2.EmbeddingBatchResponse(results=items)
+
+
+def _ocr_batch_response(results):
+    items = []
+    for result in results:
+        if isinstance(result, Exception):
+            items.append(vision_pb2.OcrResult(status=_item_status(result)))
+        else:
+            ocr = vision_pb2.OcrResponse(full_text=result[0], lines=result[1])
+            items.append(vision_pb2.OcrResult(ocr=ocr, status=_item_status()))
+    return vision_pb2.OcrBatchResponse(results=items)
+
 
-    def ExtractText(self, request, context):
+def _upsert_source(item):
+    kind = item.WhichOneof("source")
+    if kind == "image_url":
+        return "image", item.image_url
+    if kind == "text":
+        return "text", item.text
+    if kind == "vector":
+        return "vector", list(item.vector.values)
+    return None, None
+
+
+# 检索默认返回的条数和上限
+default_top_k = 10
+max_top_k = int(os.getenv("SEARCH_MAX_TOP_K", "1000"))
+
+
+# 模型加载（含预热）完成前健康检查报 NOT_SERVING；MODEL_PRELOAD=0 时未加载也算可服务，第一次请求时加载
+preload_models = os.getenv("MODEL_PRELOAD", "1") == "1"
+_vision_service = vision_pb2.DESCRIPTOR.services_by_name["VisionService"]
+vision_service_name = _vision_service.full_name
+
+
+async def _update_health(health_servicer):
+    serving = health_pb2.HealthCheckResponse.SERVING
+    not_serving = health_pb2.HealthCheckResponse.NOT_SERVING
+    all_serving = True
+    for name in registry.services:
+        state = registry.state(name)
+        ok = state == READY or (state == NOT_LOADED and not preload_models)
+        all_serving = all_serving and ok
+        await health_servicer.set(name, serving if ok else not_serving)
+    # 整体状态：本进程托管的服务全部可用时才 SERVING
+    for name in ("", vision_service_name):
+        await health_servicer.set(name, serving if all_serving else not_serving)
+
+
+def _parse_rpc_settings(value: str, convert) -> dict:
+    settings = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, setting = item.partition("=")
+        settings[name.strip()] = convert(setting.strip())
+    return settings
+
+
+# 优先级：同一条模型通道里，交互式请求先于普通请求，普通请求先于批量建库请求；
+# RPC_PRIORITIES="ExtractGraphTriples=bulk,GenerateTags=interactive" 覆盖默认值
+rpc_priorities = {
+    "EmbedText": deadlines.INTERACTIVE,
+    "ParseQueryToGraph": deadlines.INTERACTIVE,
+    "SearchByText": deadlines.INTERACTIVE,
+    "SearchByImage": deadlines.INTERACTIVE,
+    "ExtractGraphTriples": deadlines.BULK,
+    "AnalyzeImage": deadlines.BULK,
+    "Upsert": deadlines.BULK,
+    "EmbedTexts": deadlines.BULK,
+    "EmbedImages": deadlines.BULK,
+    "ExtractTextBatch": deadlines.BULK,
+    "EmbedTextStream": deadlines.BULK,
+    "EmbedImageStream": deadlines.BULK,
+    "ExtractTextStream": deadlines.BULK,
+}
+rpc_priorities.update(_parse_rpc_settings(os.getenv("RPC_PRIORITIES", ""), deadlines.priority_names.__getitem__))
+# 每个 RPC 同时处理的请求数上限，超出时直接返回 RESOURCE_EXHAUSTED，不进入模型通道：
+# RPC_LIMITS="ExtractGraphTriples=8,AnalyzeImage=4"，未配置的 RPC 不限制
+rpc_limits = _parse_rpc_settings(os.getenv("RPC_LIMITS", ""), int)
+_rpc_active = {}
+
+# handler 抛出的异常对应的状态码，按顺序匹配；其余异常按 INTERNAL 处理并记录日志
+_error_codes = (
+    (VectorIndexDisabledError, grpc.StatusCode.FAILED_PRECONDITION),
+    (deadlines.DeadlineExceededError, grpc.StatusCode.DEADLINE_EXCEEDED),
+    (LaneFullError, grpc.StatusCode.RESOURCE_EXHAUSTED),
+    (ModelUnavailableError, grpc.StatusCode.UNAVAILABLE),
+    # 输入不合法（空文本、图片过大等），批量接口里单条失败也用同一张表
+    (ValueError, grpc.StatusCode.INVALID_ARGUMENT),
+)
+
+
+def _error_code(error: Exception):
+    for error_type, code in _error_codes:
+        if isinstance(error, error_type):
+            return code
+    return grpc.StatusCode.INTERNAL
+
+
+def _set_error(rpc: str, context, error: Exception):
+    code = _error_code(error)
+    if code == grpc.StatusCode.INTERNAL:
+        logger.error("rpc failed", rpc=rpc, error=error, exc_info=True)
+    context.set_code(code)
+    context.set_details(str(error))
+
+
+def _instrumented(handler):
+    """
+    RPC 级的通用处理：
+    - 指标：请求数、在途数、耗时，以及 handler 设置的非 OK 状态码
+    - 准入：超过 rpc_limits 的请求直接拒绝
+    - 截止时间和优先级：按 context.time_remaining() 和 rpc_priorities 设置，模型通道和各处理阶段据此排队和提前放弃
+    - 错误：handler 抛出的异常按 _error_codes 设置状态码，一元 RPC 返回空响应
+    """
+    rpc = handler.__name__
+    response_type = getattr(vision_pb2, _vision_service.methods_by_name[rpc].output_type.name)
+    limit = rpc_limits.get(rpc)
+    priority = rpc_priorities.get(rpc, deadlines.NORMAL)
+
+    @contextlib.contextmanager
+    def track(context):
+        metrics.rpc_requests.labels(rpc).inc()
+        in_flight = metrics.rpc_in_flight.labels(rpc)
+        in_flight.inc()
+        start = time.perf_counter()
+        code = None
         try:
-            print(f"🔍 Request OCR: {request.image_url}")
-            result = ocr_service.extract_text(request.image_url)
-            return vision_pb2.OcrResponse(full_text=result[0], lines=result[1])
-        except Exception as e:
-            print(f"Error: {e}")
-            context.set_code(grpc.StatusCode.INTERNAL)
-            context.set_details(str(e))
-            return vision_pb2.OcrResponse()
+            yield
+            code = context.code()
+        except asyncio.CancelledError:
+            code = grpc.StatusCode.CANCELLED
+            raise
+        except grpc.aio.AbortError:
+            code = context.code()
+            raise
+        finally:
+            in_flight.dec()
+            metrics.rpc_latency.labels(rpc).observe(time.perf_counter() - start)
+            if code is not None and code != grpc.StatusCode.OK:
+                metrics.rpc_errors.labels(rpc, code.name).inc()
 
-    def ExtractGraphTriples(self, request, context):
+    @contextlib.asynccontextmanager
+    async def admit(context):
+        active = _rpc_active.get(rpc, 0)
+        if limit is not None and active >= limit:
+            metrics.rpc_rejected.labels(rpc).inc()
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, f"{rpc} is at its limit of {limit} requests")
+        _rpc_active[rpc] = active + 1
         try:
-            print(f"🔍 Request ExtractGraphTriples: {request.image_url}")
-            result = caption_service.extract_graph_triples(request.image_url)
-            return vision_pb2.GraphTriplesResponse(triple=result)
-        except Exception as e:
-            print(f"Error: {e}")
-            context.set_code(grpc.StatusCode.INTERNAL)
-            context.set_details(str(e))
-            return vision_pb2.GraphTriplesResponse()
+            with deadlines.scope(context.time_remaining(), priority):
+                yield
+        finally:
+            _rpc_active[rpc] -= 1
+
+    if inspect.isasyncgenfunction(handler):
+        @functools.wraps(handler)
+        async def stream_wrapper(self, request, context):
+            with track(context):
+                try:
+                    async with admit(context):
+                        async for response in handler(self, request, context):
+                            yield response
+                except grpc.aio.AbortError:
+                    raise
+                except Exception as e:
+                    _set_error(rpc, context, e)
+        return stream_wrapper
+
+    @functools.wraps(handler)
+    async def wrapper(self, request, context):
+        with track(context):
+            try:
+                async with admit(context):
+                    return await handler(self, request, context)
+            except grpc.aio.AbortError:
+                raise
+            except Exception as e:
+                _set_error(rpc, context, e)
+                return response_type()
+    return wrapper
+
+
+async def _run_cached(method, *args, bypass_cache=False):
+    # 先在通道外查结果缓存，命中时不必排在正在生成的请求后面
+    if not bypass_cache:
+        result = await asyncio.to_thread(method, *args, cache_only=True)
+        if result is not None:
+            return result
+    return await caption_lane.run(method, *args, bypass_cache=bypass_cache, cache_checked=not bypass_cache)
+
+
+class VisionServer(vision_pb2_grpc.VisionServiceServicer):
+
+    @_instrumented
+    async def EmbedText(self, request, context):
+        logger.info("request", rpc="EmbedText", text=request.text, sampled=True)
+        embedding_service = await registry.aget("embedding")
+        vector = await embedding_lane.run(embedding_service.embed_text, request.text)
+        return _embedding_response(vector[0], request.format)
+
+    @_instrumented
+    async def EmbedImage(self, request, context):
+        logger.info("request", rpc="EmbedImage", url=request.url, sampled=True)
+        embedding_service = await registry.aget("embedding")
+        image = await get_image_smart_async(request.url, "clip")
+        vector = await embedding_lane.run(embedding_service.embed_image, request.url, image)
+        return _embedding_response(vector[0], request.format)
 
-    def GenerateCaption(self, request, context):
+    @_instrumented
+    async def GenerateFileName(self, request, context):
+        logger.info("request", rpc="GenerateFileName", url=request.image_url, sampled=True)
+        caption_service = await registry.aget("caption")
+        image = await get_image_smart_async(request.image_url, "vlm")
+        name = await _run_cached(caption_service.generate_name, request.image_url, image,
+                                 bypass_cache=request.bypass_cache)
+        return vision_pb2.GenFileNameResponse(name=name)
+
+    @_instrumented
+    async def GenerateTags(self, request, context):
+        logger.info("request", rpc="GenerateTags", url=request.image_url, sampled=True)
+        caption_service = await registry.aget("caption")
+        image = await get_image_smart_async(request.image_url, "vlm")
+        name = await _run_cached(caption_service.generate_tags, request.image_url, image,
+                                 bypass_cache=request.bypass_cache)
+        return vision_pb2.GenTagsResponse(tag=name)
+
+    @_instrumented
+    async def ExtractText(self, request, context):
+        logger.info("request", rpc="ExtractText", url=request.image_url, sampled=True)
+        ocr_service = await registry.aget("ocr")
+        image = await get_image_smart_async(request.image_url, "ocr")
+        result = await ocr_lane.run(ocr_service.extract_text, request.image_url, image)
+        return vision_pb2.OcrResponse(full_text=result[0], lines=result[1])
+
+    @_instrumented
+    async def ExtractGraphTriples(self, request, context):
+        logger.info("request", rpc="ExtractGraphTriples", url=request.image_url, sampled=True)
+        caption_service = await registry.aget("caption")
+        image = await get_image_smart_async(request.image_url, "vlm")
+        result = await _run_cached(caption_service.extract_graph_triples, request.image_url, image,
+                                   bypass_cache=request.bypass_cache)
+        return vision_pb2.GraphTriplesResponse(triple=result)
+
+    @_instrumented
+    async def GenerateCaption(self, request, context):
+        generation = None
+        frames = 0
         try:
-            print(f"✨ Request Gen: {request.image_url}")
+            logger.info("request", rpc="GenerateCaption", url=request.image_url, sampled=True)
+            caption_service = await registry.aget("caption")
 
             prompt = request.prompt if request.prompt else "请详细描述这张图片"
+            image = await get_image_smart_async(request.image_url, "vlm")
 
-            for chunk in caption_service.stream_generate(request.image_url, prompt):
-                yield vision_pb2.StringResponse(content=chunk)
+            # 通道只负责预处理和提交，生成在引擎里进行，事件循环直接消费，不占通道线程
+            generation = await caption_lane.run(caption_service.start_stream, request.image_url, prompt, image)
+            async for frame in generation.frames(stream_frame_chars, stream_frame_ms / 1000):
+                frames += 1
+                yield vision_pb2.StringResponse(content=frame)
 
         except Exception as e:
-            print(f"Error: {e}")
-            context.set_code(grpc.StatusCode.INTERNAL)
-            context.set_details(str(e))
-            yield vision_pb2.StringResponse(content=f"[Error: {str(e)}]")
+            # 状态码由 _instrumented 设置；未预期的错误额外发一帧错误文本，只读消息内容的客户端也能看到
+            if _error_code(e) == grpc.StatusCode.INTERNAL:
+                yield vision_pb2.StringResponse(content=f"[Error: {str(e)}]")
+            raise
+        finally:
+            # 客户端断开或超过 deadline 时 grpc 会取消这个协程，生成在下一个 token 边界停止
+            if generation is not None:
+                generation.cancel()
+                model_path = caption_service.model_path
 
-    def ParseQueryToGraph(self, request, context):
-        try:
-            print(f"✨ request text: {request.text}")
-            result = caption_service.parse_query_to_graph(request.text)
-            return vision_pb2.GraphTriplesResponse(triple=result)
-        except Exception as e:
-            print(f"Error: {e}")
-            context.set_code(grpc.StatusCode.INTERNAL)
-            context.set_details(str(e))
-            return vision_pb2.GraphTriplesResponse()
+                # 取消要到下一个 token 边界才生效，等引擎真正结束序列后再记录，finish_reason 才是最终值
+                def log_finished(finished):
+                    logger.info("stream finished", rpc="GenerateCaption", frames=frames, sampled=True,
+                                **finished.stats())
+                    if finished.first_token_at is not None:
+                        ttft = finished.first_token_at - finished.submitted_at
+                        metrics.stage_latency.labels("first_token", model_path).observe(ttft)
+
+                generation.add_done_callback(log_finished)
+
+    @_instrumented
+    async def ParseQueryToGraph(self, request, context):
+        logger.info("request", rpc="ParseQueryToGraph", text=request.text, sampled=True)
+        caption_service = await registry.aget("caption")
+        result = await _run_cached(caption_service.parse_query_to_graph, request.text,
+                                   bypass_cache=request.bypass_cache)
+        return vision_pb2.GraphTriplesResponse(triple=result)
+
+    @_instrumented
+    async def AnalyzeImage(self, request, context):
+        logger.info("request", rpc="AnalyzeImage", url=request.image_url, sampled=True)
+        caption_service = await registry.aget("caption")
+        image = await get_image_smart_async(request.image_url, "vlm")
+        result = await _run_cached(caption_service.analyze_image, request.image_url, image,
+                                   bypass_cache=request.bypass_cache)
+        return vision_pb2.AnalyzeImageResponse(name=result["name"], tag=result["tags"], triple=result["triples"])
 
-def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
+    @_instrumented
+    async def Upsert(self, request, context):
+        logger.info("request", rpc="Upsert", items=len(request.items), sampled=True)
+        embedding_service = await registry.aget("embedding")
+        ids = [item.id for item in request.items]
+        sources = [_upsert_source(item) for item in request.items]
+        urls = [value if kind == "image" else None for kind, value in sources]
+        # 只预取需要编码的图片
+        fetched = iter(await get_images_smart_async([url for url in urls if url], "clip"))
+        images = [next(fetched) if url else None for url in urls]
+        results = await embedding_lane.run(embedding_service.upsert_batch, ids, sources, images)
+        statuses = [_item_status(result) for result in results]
+        return vision_pb2.UpsertResponse(results=statuses, total=len(embedding_service.index))
+
+    @_instrumented
+    async def SearchByText(self, request, context):
+        logger.info("request", rpc="SearchByText", text=request.text, sampled=True)
+        if not request.text:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details("text is required")
+            return vision_pb2.SearchResponse()
+
+        async def search(embedding_service, k):
+            return await embedding_lane.run(embedding_service.search_text, request.text, k, request.exact)
+        return await self._search(request, search)
+
+    @_instrumented
+    async def SearchByImage(self, request, context):
+        logger.info("request", rpc="SearchByImage", url=request.image_url, sampled=True)
+        if not request.image_url:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details("image_url is required")
+            return vision_pb2.SearchResponse()
+
+        async def search(embedding_service, k):
+            image = await get_image_smart_async(request.image_url, "clip")
+            return await embedding_lane.run(embedding_service.search_image, request.image_url, image, k,
+                                            request.exact)
+        return await self._search(request, search)
+
+    async def _search(self, request, search):
+        embedding_service = await registry.aget("embedding")
+        k = min(request.top_k or default_top_k, max_top_k)
+        hits = await search(embedding_service, k)
+        return vision_pb2.SearchResponse(hits=[vision_pb2.SearchHit(id=i, score=score) for i, score in hits])
+
+    @_instrumented
+    async def EmbedTexts(self, request, context):
+        logger.info("request", rpc="EmbedTexts", items=len(request.texts), sampled=True)
+        return await self._embed_texts(list(request.texts), request.format)
+
+    @_instrumented
+    async def EmbedImages(self, request, context):
+        logger.info("request", rpc="EmbedImages", items=len(request.urls), sampled=True)
+        return await self._embed_images(list(request.urls), request.format)
+
+    @_instrumented
+    async def ExtractTextBatch(self, request, context):
+        logger.info("request", rpc="ExtractTextBatch", items=len(request.image_urls), sampled=True)
+        return await self._extract_texts(list(request.image_urls))
+
+    @_instrumented
+    async def EmbedTextStream(self, request_iterator, context):
+        requests = [request async for request in request_iterator]
+        logger.info("request", rpc="EmbedTextStream", items=len(requests), sampled=True)
+        # 返回格式以第一条消息为准
+        fmt = requests[0].format if requests else vision_pb2.VECTOR
+        return await self._embed_texts([request.text for request in requests], fmt)
+
+    @_instrumented
+    async def EmbedImageStream(self, request_iterator, context):
+        requests = [request async for request in request_iterator]
+        logger.info("request", rpc="EmbedImageStream", items=len(requests), sampled=True)
+        fmt = requests[0].format if requests else vision_pb2.VECTOR
+        return await self._embed_images([request.url for request in requests], fmt)
+
+    @_instrumented
+    async def ExtractTextStream(self, request_iterator, context):
+        urls = [request.image_url async for request in request_iterator]
+        logger.info("request", rpc="ExtractTextStream", items=len(urls), sampled=True)
+        return await self._extract_texts(urls)
+
+    async def _embed_texts(self, texts, fmt=vision_pb2.VECTOR):
+        embedding_service = await registry.aget("embedding")
+        results = await embedding_lane.run(embedding_service.embed_text_batch, texts)
+        return _embedding_batch_response(results, fmt)
+
+    async def _embed_images(self, urls, fmt=vision_pb2.VECTOR):
+        embedding_service = await registry.aget("embedding")
+        images = await get_images_smart_async(urls, "clip")
+        results = await embedding_lane.run(embedding_service.embed_image_batch, urls, images)
+        return _embedding_batch_response(results, fmt)
+
+    async def _extract_texts(self, urls):
+        ocr_service = await registry.aget("ocr")
+        images = await get_images_smart_async(urls, "ocr")
+        results = await ocr_lane.run(ocr_service.extract_text_batch, urls, images)
+        return _ocr_batch_response(results)
+
+
+async def serve():
+    # 等待图片下载的请求不占线程，只有模型计算会进入各自的通道
+    max_rpcs = int(os.getenv("GRPC_MAX_CONCURRENT_RPCS", "1000"))
+    server = grpc.aio.server(maximum_concurrent_rpcs=max_rpcs)
+    metrics.start_metrics_server()
     vision_pb2_grpc.add_VisionServiceServicer_to_server(VisionServer(), server)
-    port = '[::]:50051'
+    health_servicer = health.aio.HealthServicer()
+    health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
+    await _update_health(health_servicer)
+    loop = asyncio.get_running_loop()
+    registry.add_listener(lambda name, state: asyncio.run_coroutine_threadsafe(_update_health(health_servicer), loop))
+    port = f"[::]:{os.getenv('GRPC_PORT', '50051')}"
     server.add_insecure_port(port)
-    print(f"✅ gRPC Server started on {port}")
-    server.start()
+    await server.start()
+    logger.info("gRPC server started", port=port, services=",".join(registry.services))
+    # 端口先绑定再加载模型；MODEL_PRELOAD=0 时改为第一次请求时加载
+    if preload_models:
+        registry.preload()
     try:
-        while True:
-            time.sleep(86400)
-    except KeyboardInterrupt:
-        server.stop(0)
+        await server.wait_for_termination()
+    finally:
+        await health_servicer.enter_graceful_shutdown()
+        await server.stop(5)
+        await close_http_session()
 
 
 if __name__ == '__main__':
-    serve()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
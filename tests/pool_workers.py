@@ -0,0 +1,28 @@
+"""WorkerPool 测试用的子进程服务，需要能被 spawn 出来的子进程按模块名导入"""
+import os
+import time
+
+
+class Echo:
+    def __init__(self):
+        # 测试通过这个文件控制子进程加载是否失败 / 变慢
+        flag = os.environ.get("POOL_TEST_FLAG")
+        if flag and os.path.exists(flag):
+            with open(flag) as f:
+                mode = f.read()
+            if mode == "fail":
+                raise RuntimeError("load failed")
+            time.sleep(float(mode))
+
+    def add_one(self, array):
+        return array + 1
+
+    def pid(self):
+        return os.getpid()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return os.getpid()
+
+    def die(self):
+        os._exit(1)
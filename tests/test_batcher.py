@@ -0,0 +1,73 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from utils.batcher import MicroBatcher
+
+
+def test_coalesces_concurrent_items():
+    sizes = []
+
+    def double(items):
+        sizes.append(len(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher("test", double, max_batch_size=8, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(8)]
+    assert [future.result(5) for future in futures] == [i * 2 for i in range(8)]
+    assert sizes == [8]
+
+
+def test_batch_error_fails_every_item():
+    def fail(items):
+        raise RuntimeError("forward failed")
+
+    batcher = MicroBatcher("test", fail, max_batch_size=4, max_wait_ms=1)
+    with pytest.raises(RuntimeError):
+        batcher.submit(1).result(5)
+
+
+def test_wrong_result_count_is_an_error():
+    batcher = MicroBatcher("test", lambda items: [], max_batch_size=4, max_wait_ms=1)
+    with pytest.raises(RuntimeError):
+        batcher.submit(1).result(5)
+
+
+def test_future_batches_run_up_to_max_in_flight():
+    executor = ThreadPoolExecutor(4)
+    release = threading.Event()
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def work(items):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        release.wait(5)
+        with lock:
+            running[0] -= 1
+        return items
+
+    # batch_fn 返回 Future，发车线程不等结果
+    batcher = MicroBatcher("test", lambda items: executor.submit(work, items), max_batch_size=1, max_wait_ms=0,
+                           max_in_flight=3)
+    futures = [batcher.submit(i) for i in range(6)]
+    time.sleep(0.1)
+    assert peak[0] == 3
+    release.set()
+    assert [future.result(5) for future in futures] == list(range(6))
+    assert peak[0] == 3
+
+
+def test_failed_future_batch_releases_its_slot():
+    def fail(items):
+        future = Future()
+        future.set_exception(RuntimeError("worker exited"))
+        return future
+
+    batcher = MicroBatcher("test", fail, max_batch_size=1, max_wait_ms=0, max_in_flight=1)
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            batcher.submit(1).result(5)
@@ -0,0 +1,194 @@
+import asyncio
+import itertools
+import threading
+import time
+
+import pytest
+
+from core.generation_engine import EngineFullError, GenerationBackend, GenerationEngine
+from core.structured_output import JsonStop
+from utils import deadlines
+
+
+class ScriptedBackend(GenerationBackend):
+    """按 inputs["tokens"] 逐个吐出文本段，吐完即遇到结束符；不给 tokens 时无限生成 "x" """
+
+    def __init__(self, step_delay: float = 0.002):
+        self.step_delay = step_delay
+        self.started = []
+        self.finished = []
+        self.fail = False
+
+    def start(self, request):
+        self.started.append(request.inputs.get("name"))
+        tokens = request.inputs.get("tokens")
+        return {"name": request.inputs.get("name"),
+                "tokens": iter(tokens) if tokens is not None else itertools.repeat("x")}
+
+    def step(self, states):
+        time.sleep(self.step_delay)
+        if self.fail:
+            raise RuntimeError("backend failed")
+        results = []
+        for state in states:
+            segment = next(state["tokens"], None)
+            results.append(("", True) if segment is None else (segment, False))
+        return results
+
+    def finish(self, state):
+        self.finished.append(state["name"])
+
+
+def _wait_until(condition, timeout: float = 5):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "condition not reached"
+        time.sleep(0.001)
+
+
+@pytest.fixture
+def backend():
+    return ScriptedBackend()
+
+
+def test_admits_new_requests_at_token_boundaries(backend):
+    engine = GenerationEngine(backend, max_concurrent=2)
+    long = engine.submit({"name": "long"}, max_tokens=10_000)
+    _wait_until(lambda: long.tokens >= 3)
+
+    short = engine.submit({"name": "short", "tokens": ["a", "b"]}, max_tokens=10)
+    assert short.result(5) == "ab"
+    # 后来的短请求在长请求生成途中加入并先结束
+    assert long.finished_at is None
+    long.cancel()
+    long.wait(5)
+
+
+def test_waits_for_a_free_slot(backend):
+    engine = GenerationEngine(backend, max_concurrent=1)
+    first = engine.submit({"name": "first", "tokens": ["a"] * 5}, max_tokens=10)
+    second = engine.submit({"name": "second", "tokens": ["b"]}, max_tokens=10)
+    assert second.result(5) == "b"
+    assert first.finished_at <= second.first_token_at
+
+
+def test_cancel_active_request_releases_backend_state(backend):
+    engine = GenerationEngine(backend)
+    request = engine.submit({"name": "endless"}, max_tokens=10_000)
+    _wait_until(lambda: request.tokens >= 1)
+    request.cancel()
+    assert request.wait(5)
+    assert request.finish_reason == "cancelled"
+    assert backend.finished == ["endless"]
+
+
+def test_cancel_pending_request_never_starts(backend):
+    engine = GenerationEngine(backend, max_concurrent=1)
+    running = engine.submit({"name": "running"}, max_tokens=10_000)
+    _wait_until(lambda: running.tokens >= 1)
+    pending = engine.submit({"name": "pending"}, max_tokens=10)
+    pending.cancel()
+    running.cancel()
+    assert pending.wait(5)
+    assert pending.finish_reason == "cancelled"
+    assert "pending" not in backend.started
+
+
+def test_max_tokens(backend):
+    engine = GenerationEngine(backend)
+    request = engine.submit({"name": "endless"}, max_tokens=5)
+    assert request.result(5) == "xxxxx"
+    assert request.finish_reason == "length"
+    assert request.tokens == 5
+
+
+def test_end_of_sequence(backend):
+    engine = GenerationEngine(backend)
+    request = engine.submit({"name": "eos", "tokens": ["你", "好"]}, max_tokens=10)
+    assert request.result(5) == "你好"
+    assert request.finish_reason == "stop"
+
+
+def test_stop_condition(backend):
+    engine = GenerationEngine(backend)
+    stop = JsonStop(prefix="[", max_items=2)
+    tokens = ['"a"', ",", '"b"', ",", '"c"', "]"]
+    request = engine.submit({"name": "json", "tokens": tokens}, max_tokens=10, stop=stop)
+    assert request.result(5) == '"a","b"'
+    assert request.finish_reason == "stop_condition"
+    assert stop.repair() == '["a","b"]'
+
+
+def test_backend_error_fails_active_requests(backend):
+    engine = GenerationEngine(backend)
+    request = engine.submit({"name": "endless"}, max_tokens=10_000)
+    _wait_until(lambda: request.tokens >= 1)
+    backend.fail = True
+    with pytest.raises(RuntimeError):
+        request.result(5)
+    assert request.finish_reason == "error"
+
+
+def test_rejects_when_full_and_ignores_cancelled_entries(backend):
+    engine = GenerationEngine(backend, max_concurrent=1, max_pending=1)
+    running = engine.submit({"name": "running"}, max_tokens=10_000)
+    queued = engine.submit({"name": "queued"}, max_tokens=10_000)
+    with pytest.raises(EngineFullError):
+        engine.submit({"name": "rejected"}, max_tokens=10)
+
+    queued.cancel()
+    accepted = engine.submit({"name": "accepted"}, max_tokens=10_000)
+    assert queued.wait(5)
+    assert queued.finish_reason == "cancelled"
+    running.cancel()
+    accepted.cancel()
+    assert accepted.wait(5)
+
+
+def test_pending_requests_follow_priority(backend):
+    engine = GenerationEngine(backend, max_concurrent=1)
+    running = engine.submit({"name": "running"}, max_tokens=10_000)
+    _wait_until(lambda: running.tokens >= 1)
+    with deadlines.scope(priority=deadlines.BULK):
+        bulk = engine.submit({"name": "bulk", "tokens": ["b"]}, max_tokens=10)
+    with deadlines.scope(priority=deadlines.INTERACTIVE):
+        interactive = engine.submit({"name": "interactive", "tokens": ["i"]}, max_tokens=10)
+    running.cancel()
+    bulk.result(5)
+    interactive.result(5)
+    assert backend.started == ["running", "interactive", "bulk"]
+
+
+def test_frames_coalesce_to_min_chars():
+    backend = ScriptedBackend(step_delay=0.001)
+    engine = GenerationEngine(backend)
+    request = engine.submit({"name": "frames", "tokens": list("abcdefghijklmnopqrstuvwxyz")}, max_tokens=100)
+
+    async def collect():
+        return [frame async for frame in request.frames(min_chars=5, max_delay=10)]
+
+    frames = asyncio.run(collect())
+    assert "".join(frames) == "abcdefghijklmnopqrstuvwxyz"
+    assert all(len(frame) >= 5 for frame in frames[:-1])
+
+
+def test_frames_merge_backlog_for_slow_consumers(backend):
+    engine = GenerationEngine(backend)
+    request = engine.submit({"name": "done", "tokens": list("abc")}, max_tokens=10)
+    request.result(5)
+
+    async def collect():
+        return [frame async for frame in request.frames()]
+
+    # 消费者开始读之前已经生成完的内容合并成一帧
+    assert asyncio.run(collect()) == ["abc"]
+
+
+def test_done_callback_runs_after_finish(backend):
+    engine = GenerationEngine(backend)
+    finished = threading.Event()
+    reasons = []
+    request = engine.submit({"name": "callback", "tokens": ["a"]}, max_tokens=10)
+    request.add_done_callback(lambda r: (reasons.append(r.finish_reason), finished.set()))
+    assert finished.wait(5)
+    assert reasons == ["stop"]
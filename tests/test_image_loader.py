@@ -0,0 +1,157 @@
+import asyncio
+import struct
+import zlib
+from io import BytesIO
+
+import pytest
+from aiohttp import web
+from PIL import Image
+
+from utils import image_loader
+from utils.image_loader import ImageTooLargeError
+
+
+def _jpeg(size=(64, 48)) -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", size, "orange").save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def _png_header(width: int, height: int) -> bytes:
+    """PNG 签名、IHDR 和 IDAT 块头，Pillow 读到 IDAT 就能给出尺寸，后面的像素数据随便填"""
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + struct.pack(">I", len(ihdr)) + b"IHDR" + ihdr
+            + struct.pack(">I", zlib.crc32(b"IHDR" + ihdr)) + struct.pack(">I", 1 << 30) + b"IDAT")
+
+
+class _Server:
+    """本地图片服务器：/body/<name> 分块返回 bodies[name]，不带 Content-Length；/endless 一直写到客户端断开"""
+
+    def __init__(self, bodies: dict, chunk: int = 4096, delay: float = 0.0):
+        self.bodies = bodies
+        self.chunk = chunk
+        self.delay = delay
+        self.requests = 0
+        self.sent = 0
+        self.runner = None
+        self.base = None
+
+    async def _body(self, request):
+        self.requests += 1
+        body = self.bodies[request.match_info["name"]]
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for start in range(0, len(body), self.chunk):
+            await asyncio.sleep(self.delay)
+            await response.write(body[start:start + self.chunk])
+        await response.write_eof()
+        return response
+
+    async def _sized(self, request):
+        self.requests += 1
+        return web.Response(body=b"\0" * int(request.match_info["size"]))
+
+    async def _endless(self, request):
+        self.requests += 1
+        response = web.StreamResponse()
+        await response.prepare(request)
+        try:
+            while self.sent < 256 << 20:
+                await response.write(b"\0" * self.chunk)
+                self.sent += self.chunk
+        except ConnectionError:
+            pass
+        return response
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get("/body/{name}", self._body)
+        app.router.add_get("/sized/{size}", self._sized)
+        app.router.add_get("/endless", self._endless)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base = f"http://127.0.0.1:{port}"
+        return self
+
+    async def __aexit__(self, *exc):
+        # 共享的 ClientSession 绑定在当前事件循环上，每个用例结束时关掉
+        await image_loader.close_http_session()
+        await self.runner.cleanup()
+
+
+def test_streams_body_in_chunks():
+    body = _jpeg((640, 480))
+
+    async def main():
+        async with _Server({"a": body}, chunk=1024) as server:
+            return await image_loader.fetch_image_bytes_async(f"{server.base}/body/a")
+
+    assert asyncio.run(main()) == body
+
+
+def test_rejects_declared_size_over_limit(monkeypatch):
+    monkeypatch.setattr(image_loader, "max_image_bytes", 1000)
+
+    async def main():
+        async with _Server({}) as server:
+            await image_loader.fetch_image_bytes_async(f"{server.base}/sized/5000")
+
+    with pytest.raises(ImageTooLargeError, match="body is 5000 bytes"):
+        asyncio.run(main())
+
+
+def test_aborts_stream_over_limit(monkeypatch):
+    monkeypatch.setattr(image_loader, "max_image_bytes", 256 << 10)
+
+    async def main():
+        async with _Server({}, chunk=64 << 10) as server:
+            with pytest.raises(ImageTooLargeError, match="exceeds"):
+                await image_loader.fetch_image_bytes_async(f"{server.base}/endless")
+            await asyncio.sleep(0.2)
+            return server.sent
+
+    # 超限后立刻断开，服务端远远写不完
+    assert asyncio.run(main()) < 64 << 20
+
+
+def test_rejects_pixel_count_from_header(monkeypatch):
+    monkeypatch.setattr(image_loader, "max_image_pixels", 1000 * 1000)
+    # 文件头之后的数据还有很多，但看到尺寸就应该停下
+    body = _png_header(3000, 3000) + b"\0" * (1 << 20)
+
+    async def main():
+        async with _Server({"big": body}, chunk=1024, delay=0.001) as server:
+            await image_loader.fetch_image_bytes_async(f"{server.base}/body/big")
+
+    with pytest.raises(ImageTooLargeError, match="3000x3000"):
+        asyncio.run(main())
+
+
+def test_decompression_bomb_is_too_large():
+    body = _png_header(40000, 40000) + b"\0" * 1024
+
+    async def main():
+        async with _Server({"bomb": body}) as server:
+            await image_loader.fetch_image_bytes_async(f"{server.base}/body/bomb")
+
+    with pytest.raises(ImageTooLargeError):
+        asyncio.run(main())
+
+
+def test_concurrent_misses_download_once():
+    body = _jpeg()
+
+    async def main():
+        async with _Server({"shared": body}, chunk=256, delay=0.01) as server:
+            url = f"{server.base}/body/shared"
+            before = image_loader.single_flight.deduplicated
+            results = await asyncio.gather(*(image_loader.get_image_bytes_async(url) for _ in range(5)))
+            return results, server.requests, image_loader.single_flight.deduplicated - before
+
+    results, requests, deduplicated = asyncio.run(main())
+    assert results == [body] * 5
+    assert requests == 1
+    assert deduplicated == 4
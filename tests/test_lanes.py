@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+from utils import deadlines
+from utils.lanes import Lane, LaneFullError
+
+
+@pytest.fixture
+def blocked_lane():
+    """单线程通道，唯一的工作线程被占住，直到调用 release()"""
+    lane = Lane("test", max_concurrency=1, max_queue=1)
+    started, release = threading.Event(), threading.Event()
+    blocker = lane.submit(lambda: (started.set(), release.wait(5)))
+    assert started.wait(5)
+    yield lane, release
+    release.set()
+    blocker.result(5)
+
+
+def test_higher_priority_runs_first():
+    lane = Lane("test", max_concurrency=1, max_queue=4)
+    started, release = threading.Event(), threading.Event()
+    lane.submit(lambda: (started.set(), release.wait(5)))
+    assert started.wait(5)
+
+    order = []
+    with deadlines.scope(priority=deadlines.BULK):
+        bulk = lane.submit(order.append, "bulk")
+    with deadlines.scope(priority=deadlines.NORMAL):
+        normal = lane.submit(order.append, "normal")
+    with deadlines.scope(priority=deadlines.INTERACTIVE):
+        interactive = lane.submit(order.append, "interactive")
+    release.set()
+    for future in (bulk, normal, interactive):
+        future.result(5)
+    assert order == ["interactive", "normal", "bulk"]
+
+
+def test_full_lane_rejects_same_priority(blocked_lane):
+    lane, _ = blocked_lane
+    lane.submit(lambda: None)
+    with pytest.raises(LaneFullError):
+        lane.submit(lambda: None)
+
+
+def test_higher_priority_evicts_newest_lower_priority(blocked_lane):
+    lane, release = blocked_lane
+    with deadlines.scope(priority=deadlines.BULK):
+        bulk = lane.submit(lambda: "bulk")
+    with deadlines.scope(priority=deadlines.INTERACTIVE):
+        interactive = lane.submit(lambda: "interactive")
+
+    with pytest.raises(LaneFullError):
+        bulk.result(5)
+    assert lane.shed == 1
+    release.set()
+    assert interactive.result(5) == "interactive"
+
+
+def test_lower_priority_does_not_evict(blocked_lane):
+    lane, _ = blocked_lane
+    with deadlines.scope(priority=deadlines.INTERACTIVE):
+        lane.submit(lambda: None)
+    with deadlines.scope(priority=deadlines.BULK):
+        with pytest.raises(LaneFullError):
+            lane.submit(lambda: None)
+    assert lane.shed == 0
+
+
+def test_expired_tasks_are_dropped(blocked_lane):
+    lane, release = blocked_lane
+    ran = []
+    with deadlines.scope(timeout=0.01):
+        future = lane.submit(ran.append, True)
+    time.sleep(0.02)
+    release.set()
+    with pytest.raises(deadlines.DeadlineExceededError):
+        future.result(5)
+    assert ran == []
+    assert lane.expired == 1
+
+
+def test_task_runs_in_submitter_context():
+    lane = Lane("test", max_concurrency=1, max_queue=1)
+    with deadlines.scope(timeout=60, priority=deadlines.INTERACTIVE):
+        future = lane.submit(lambda: (deadlines.priority(), deadlines.remaining() is not None))
+    assert future.result(5) == (deadlines.INTERACTIVE, True)
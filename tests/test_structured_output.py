@@ -0,0 +1,71 @@
+from core.structured_output import JsonStop, first_line_stop
+
+
+def _feed(stop: JsonStop, chunks: list) -> bool:
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        if stop(text):
+            return True
+    return False
+
+
+def test_stops_when_array_closes():
+    stop = JsonStop(prefix="[")
+    assert _feed(stop, ['"a"', ", ", '"b"', "]", " 多余的解释"])
+    assert stop.repair() == '["a", "b"]'
+
+
+def test_stops_when_object_closes():
+    stop = JsonStop(prefix="{")
+    assert _feed(stop, ['"name": "山', '巅"', "}", "\n"])
+    assert stop.repair() == '{"name": "山巅"}'
+
+
+def test_brackets_and_quotes_inside_strings_are_ignored():
+    stop = JsonStop(prefix="[")
+    assert not _feed(stop, ['"a]b"', ', "c\\"]"'])
+    assert stop.items == 2
+    assert _feed(stop, ['"a]b"', ', "c\\"]"', "]"])
+
+
+def test_max_items_stops_early():
+    stop = JsonStop(prefix="[", max_items=2)
+    assert _feed(stop, ['{"s": "男子", "p": "站在", "o": "山顶"}', ", ", '{"s": "男子"', ', "p": "面向", "o": "太阳"}'])
+    assert stop.repair() == '[{"s": "男子", "p": "站在", "o": "山顶"}, {"s": "男子", "p": "面向", "o": "太阳"}]'
+
+
+def test_repair_drops_items_beyond_max_items_in_one_chunk():
+    stop = JsonStop(prefix="[", max_items=2)
+    assert _feed(stop, ['"a", "b", "c"'])
+    assert stop.repair() == '["a", "b"]'
+
+
+def test_repair_truncated_array_keeps_complete_items():
+    stop = JsonStop(prefix="[")
+    assert not _feed(stop, ['{"s": "a", "p": "b", "o": "c"}, ', '{"s": "d", "p'])
+    assert stop.repair() == '[{"s": "a", "p": "b", "o": "c"}]'
+
+
+def test_repair_nested_arrays_count_as_one_item():
+    stop = JsonStop(prefix="[")
+    assert _feed(stop, ["[1, [2, 3]], ", "[4]", "]"])
+    assert stop.items == 2
+    assert stop.repair() == "[[1, [2, 3]], [4]]"
+
+
+def test_repair_without_complete_items_returns_text():
+    stop = JsonStop(prefix="[")
+    assert not _feed(stop, ['"未写'])
+    assert stop.repair() == '["未写'
+
+
+def test_repair_truncated_object_is_left_as_is():
+    stop = JsonStop(prefix="{")
+    assert not _feed(stop, ['"name": "标题", "tags": ["a"'])
+    assert stop.repair() == '{"name": "标题", "tags": ["a"'
+
+
+def test_first_line_stop():
+    assert not first_line_stop("\n山巅日出")
+    assert first_line_stop("山巅日出\n说明")
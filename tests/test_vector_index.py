@@ -0,0 +1,81 @@
+import time
+
+import numpy as np
+
+from core.vector_index import VectorIndex
+
+
+def _vectors(count: int, dim: int = 8, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _wait_trained(index: VectorIndex, timeout: float = 5):
+    end = time.monotonic() + timeout
+    while index._training or index._ivf is None and index._failed_at is None:
+        assert time.monotonic() < end, "training did not finish"
+        time.sleep(0.01)
+
+
+def test_exact_search_returns_nearest(tmp_path):
+    index = VectorIndex(str(tmp_path), "test", 8, initial_capacity=4)
+    vectors = _vectors(50)
+    for i, vector in enumerate(vectors):
+        index.upsert(f"id-{i}", vector)
+    hits = index.search(vectors[7], k=3)
+    assert hits[0][0] == "id-7"
+    assert len(hits) == 3
+    index.close()
+
+
+def test_reopen_restores_ids(tmp_path):
+    vectors = _vectors(5)
+    index = VectorIndex(str(tmp_path), "test", 8)
+    for i, vector in enumerate(vectors):
+        index.upsert(f"id-{i}", vector)
+    index.close()
+
+    reopened = VectorIndex(str(tmp_path), "test", 8)
+    assert len(reopened) == 5
+    assert reopened.search(vectors[3], k=1)[0][0] == "id-3"
+    reopened.close()
+
+
+def test_nlist_larger_than_sample_is_clamped(tmp_path):
+    index = VectorIndex(str(tmp_path), "test", 8, mode="ivf", nlist=100, ivf_min_vectors=10)
+    vectors = _vectors(20)
+    for i, vector in enumerate(vectors):
+        index.upsert(f"id-{i}", vector)
+    _wait_trained(index)
+    assert index._failed_at is None
+    assert len(index._ivf[0]) == 20
+    assert index.search(vectors[5], k=1)[0][0] == "id-5"
+    index.close()
+
+
+def test_failed_training_waits_for_more_rows(tmp_path, monkeypatch):
+    calls = []
+
+    def fail(self, count):
+        calls.append(count)
+        raise RuntimeError("training failed")
+
+    monkeypatch.setattr(VectorIndex, "_build_ivf", fail)
+    index = VectorIndex(str(tmp_path), "test", 8, mode="ivf", ivf_min_vectors=10)
+    vectors = _vectors(30)
+    for i, vector in enumerate(vectors[:10]):
+        index.upsert(f"id-{i}", vector)
+    _wait_trained(index)
+    time.sleep(0.05)
+    assert calls == [10]
+
+    # 行数增长不到 20% 时不重试
+    index.upsert("id-10", vectors[10])
+    _wait_trained(index)
+    assert calls == [10]
+
+    for i in range(11, 12):
+        index.upsert(f"id-{i}", vectors[i])
+    _wait_trained(index)
+    assert calls == [10, 12]
+    index.close()
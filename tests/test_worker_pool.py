@@ -0,0 +1,84 @@
+import time
+
+import numpy as np
+import pytest
+
+from core import worker_pool
+from core.worker_pool import WorkerPool
+
+
+@pytest.fixture
+def flag(tmp_path, monkeypatch):
+    path = tmp_path / "flag"
+    monkeypatch.setenv("POOL_TEST_FLAG", str(path))
+    monkeypatch.setattr(worker_pool, "liveness_interval", 0.05)
+    monkeypatch.setattr(worker_pool, "restart_backoff", 0.05)
+    return path
+
+
+def _wait_until(condition, timeout: float = 20):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "condition not reached"
+        time.sleep(0.01)
+
+
+def test_shared_memory_round_trip(flag):
+    pool = WorkerPool("test", "pool_workers", "Echo", 1, 1, warmup=False)
+    try:
+        array = np.arange(12, dtype=np.float32).reshape(3, 4)
+        np.testing.assert_array_equal(pool.call("add_one", array), array + 1)
+    finally:
+        pool.close()
+
+
+def test_worker_exit_fails_only_its_tasks(flag):
+    pool = WorkerPool("test", "pool_workers", "Echo", 2, 1, warmup=False)
+    try:
+        slow = pool.submit("sleep", 1)
+        dying = pool.submit("die")
+        with pytest.raises(RuntimeError):
+            dying.result(10)
+        assert slow.result(10) > 0
+    finally:
+        pool.close()
+
+
+def test_restarting_worker_gets_no_tasks_until_ready(flag):
+    pool = WorkerPool("test", "pool_workers", "Echo", 2, 1, warmup=False)
+    try:
+        survivor = pool._processes[1].pid
+        flag.write_text("1.5")
+        # 两个进程都空闲时任务派给 0 号
+        with pytest.raises(RuntimeError):
+            pool.call("die")
+        _wait_until(lambda: pool._states[0] == worker_pool.LOADING)
+        # 重启的进程还在加载，新任务都交给仍然就绪的进程
+        assert {pool.call("pid") for _ in range(4)} == {survivor}
+        _wait_until(lambda: pool._states[0] == worker_pool.READY)
+    finally:
+        pool.close()
+
+
+def test_stops_restarting_after_repeated_load_failures(flag, monkeypatch):
+    monkeypatch.setattr(worker_pool, "max_load_failures", 3)
+    pool = WorkerPool("test", "pool_workers", "Echo", 1, 1, warmup=False)
+    try:
+        flag.write_text("fail")
+        with pytest.raises(RuntimeError):
+            pool.call("die")
+        _wait_until(lambda: pool._states[0] == worker_pool.FAILED)
+        assert pool._failures[0] == 3
+        with pytest.raises(RuntimeError, match="no live workers"):
+            pool.call("pid")
+    finally:
+        pool.close()
+
+
+def test_close_does_not_restart_workers(flag):
+    pool = WorkerPool("test", "pool_workers", "Echo", 1, 1, warmup=False)
+    process = pool._processes[0]
+    pool.close()
+    time.sleep(0.3)
+    assert pool._processes[0] is process
+    assert not process.is_alive()
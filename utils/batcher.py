@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from utils.metrics import batch_queue_wait, batch_size
+
+
+class MicroBatcher:
+    """
+    把并发的单条请求合并成一个批次，交给 batch_fn 一次性处理。
+    攒够 max_batch_size 条或者最早的请求等待超过 max_wait_ms 就立即发车。
+    batch_fn 接收 list，返回与输入等长、顺序一致的结果序列，或者返回这样一个序列的 Future：
+    返回 Future 时发车线程不等结果，接着攒下一批，最多 max_in_flight 个批次同时在途（例如交给多个子进程）。
+    """
+
+    def __init__(self, name: str, batch_fn, max_batch_size: int = 32, max_wait_ms: float = 5.0,
+                 max_in_flight: int = 1):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._slots = threading.Semaphore(max(1, max_in_flight))
+        self._thread = threading.Thread(target=self._run, name=f"batcher-{name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        with self._cond:
+            self._queue.append((item, future, time.perf_counter()))
+            self._cond.notify()
+        return future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+
+            deadline = self._queue[0][2] + self.max_wait
+            while len(self._queue) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            size = min(len(self._queue), self.max_batch_size)
+            return [self._queue.popleft() for _ in range(size)]
+
+    def _run(self):
+        while True:
+            # 在途批次占满时不发车，新请求继续排队，等到槽位空出来时正好攒成更大的批次
+            self._slots.acquire()
+            batch = self._next_batch()
+            # 调用方已经取消的请求不再占用批次
+            batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if not batch:
+                self._slots.release()
+                continue
+
+            now = time.perf_counter()
+            batch_size.labels(self.name).observe(len(batch))
+            waits = batch_queue_wait.labels(self.name)
+            for _, _, enqueued in batch:
+                waits.observe(now - enqueued)
+
+            try:
+                results = self.batch_fn([item for item, _, _ in batch])
+            except Exception as e:
+                self._deliver(batch, None, e)
+                continue
+            if isinstance(results, Future):
+                results.add_done_callback(lambda future, batch=batch: self._deliver(batch, future))
+            else:
+                self._deliver(batch, results)
+
+    def _deliver(self, batch: list, results, error: Exception = None):
+        try:
+            if isinstance(results, Future):
+                error = results.exception()
+                results = None if error is not None else results.result()
+            if error is None and len(results) != len(batch):
+                error = RuntimeError(f"{self.name}: batch_fn returned {len(results)} results for {len(batch)} items")
+            if error is not None:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                return
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+        finally:
+            self._slots.release()
@@ -0,0 +1,153 @@
+import asyncio
+import sys
+from concurrent.futures import Future
+from threading import Lock
+
+from cachetools import FIFOCache, LFUCache, LRUCache, TTLCache
+
+
+def sizeof(value) -> int:
+    """估算缓存值占用的字节数：numpy / mlx 数组、torch 张量、PIL 图片、bytes 以及它们组成的容器"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if hasattr(value, "element_size") and hasattr(value, "nelement"):
+        return value.element_size() * value.nelement()
+    if hasattr(value, "getbands") and hasattr(value, "size"):
+        return value.size[0] * value.size[1] * len(value.getbands())
+    if isinstance(value, dict):
+        return sum(sizeof(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class _CountingMixin:
+    evictions = 0
+
+    def popitem(self):
+        # cachetools 只在为新值腾空间时调用 popitem，过期清理走的是 __delitem__
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+
+_policies = {
+    "ttl": type("CountingTTLCache", (_CountingMixin, TTLCache), {}),
+    "lru": type("CountingLRUCache", (_CountingMixin, LRUCache), {}),
+    "lfu": type("CountingLFUCache", (_CountingMixin, LFUCache), {}),
+    "fifo": type("CountingFIFOCache", (_CountingMixin, FIFOCache), {}),
+}
+
+
+class SizedCache:
+    """
+    按字节计预算的线程安全缓存。policy 为 ttl（过期 + LRU 淘汰）、lru、lfu 或 fifo。
+    单个值超过整个预算时不缓存。
+    """
+
+    def __init__(self, name: str, max_bytes: int, ttl: float = 180, policy: str = "ttl"):
+        if policy not in _policies:
+            raise ValueError(f"unknown cache policy: {policy}")
+        self.name = name
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        kwargs = {"ttl": ttl} if policy == "ttl" else {}
+        self._cache = _policies[policy](maxsize=max_bytes, getsizeof=sizeof, **kwargs)
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def peek(self, key):
+        """不计入命中统计的查询，用于 single-flight 内部的二次检查"""
+        with self._lock:
+            return self._cache.get(key)
+
+    def put(self, key, value):
+        with self._lock:
+            try:
+                self._cache[key] = value
+            except ValueError:
+                # 单个值比整个预算还大
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "entries": len(self._cache),
+                "bytes": self._cache.currsize,
+                "max_bytes": self._cache.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self._cache.evictions,
+            }
+
+
+class SingleFlight:
+    """
+    同一个键同时只执行一次加载：第一个未命中的调用方负责加载，其余调用方等待它的结果。
+    同步线程和 asyncio 协程共用同一张在途表，所以两边的并发未命中也会合并。
+    """
+
+    def __init__(self):
+        self.deduplicated = 0
+        self._calls = {}
+        self._lock = Lock()
+
+    def _begin(self, key):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.deduplicated += 1
+                return future, False
+            future = Future()
+            self._calls[key] = future
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn):
+        future, leader = self._begin(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    async def do_async(self, key, coro_fn):
+        future, leader = self._begin(key)
+        if leader:
+            # 加载放在独立的任务里：发起方被取消（客户端断开、超过 deadline）时加载照常完成，
+            # 共享的 Future 不会因此以 CancelledError 结束，其余等待方不受影响
+            task = asyncio.ensure_future(coro_fn())
+            task.add_done_callback(lambda t: self._finish_task(key, future, t))
+        # shield：某个等待方被取消时不能连带取消共享的 Future
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    def _finish_task(self, key, future, task):
+        if task.cancelled():
+            self._finish(key, future, error=asyncio.CancelledError())
+        elif task.exception() is not None:
+            self._finish(key, future, error=task.exception())
+        else:
+            self._finish(key, future, result=task.result())
@@ -0,0 +1,50 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# 优先级，数值越小越先执行：交互式查询排在批量建库前面
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+priority_names = {"interactive": INTERACTIVE, "normal": NORMAL, "bulk": BULK}
+
+# 当前请求的截止时间（time.monotonic()）和优先级；通道线程和 asyncio.to_thread 会带上调用方的上下文
+_deadline = ContextVar("deadline", default=None)
+_priority = ContextVar("priority", default=NORMAL)
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+@contextmanager
+def scope(timeout: float = None, priority: int = NORMAL):
+    """timeout 为剩余秒数（grpc 的 context.time_remaining()），None 表示没有截止时间"""
+    deadline_token = _deadline.set(None if timeout is None else time.monotonic() + timeout)
+    priority_token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _deadline.reset(deadline_token)
+        _priority.reset(priority_token)
+
+
+def deadline():
+    return _deadline.get()
+
+
+def priority() -> int:
+    return _priority.get()
+
+
+def remaining():
+    """距截止时间的秒数，没有截止时间时返回 None"""
+    value = _deadline.get()
+    return None if value is None else value - time.monotonic()
+
+
+def check(stage: str):
+    """在开销大的阶段（下载、预处理、前向）之前调用，调用方已经超时就不必再做"""
+    value = _deadline.get()
+    if value is not None and time.monotonic() >= value:
+        raise DeadlineExceededError(f"deadline exceeded before {stage}")
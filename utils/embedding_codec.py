@@ -0,0 +1,37 @@
+import numpy as np
+
+# 紧凑传输格式，名字与 vision.proto 里的 EmbeddingFormat 对应（小写）
+formats = ("float32", "float16", "int8", "binary")
+
+
+def encode_embedding(vector: np.ndarray, fmt: str) -> tuple[bytes, float]:
+    """
+    把一维向量直接从 numpy 缓冲区编码成 bytes，返回 (data, scale)。
+    float32 / float16：小端序原始字节；int8：对称量化，原值 ≈ data[i] * scale；
+    binary：每维取符号位打包成 1 bit（np.packbits 的大端位序），长度 ceil(dim / 8)，适合汉明距离粗排。
+    """
+    vector = np.asarray(vector).reshape(-1)
+    if fmt == "float32":
+        return vector.astype("<f4", copy=False).tobytes(), 1.0
+    if fmt == "float16":
+        return vector.astype("<f2").tobytes(), 1.0
+    if fmt == "int8":
+        peak = float(np.abs(vector).max()) if vector.size else 0.0
+        scale = peak / 127 if peak > 0 else 1.0
+        return np.rint(vector / scale).astype(np.int8).tobytes(), scale
+    if fmt == "binary":
+        return np.packbits(vector > 0).tobytes(), 1.0
+    raise ValueError(f"Unknown embedding format: {fmt}")
+
+
+def decode_embedding(data: bytes, fmt: str, dim: int, scale: float = 1.0) -> np.ndarray:
+    """encode_embedding 的逆操作；binary 解出来是 0/1 的 uint8 向量"""
+    if fmt == "float32":
+        return np.frombuffer(data, "<f4", dim)
+    if fmt == "float16":
+        return np.frombuffer(data, "<f2", dim).astype(np.float32)
+    if fmt == "int8":
+        return np.frombuffer(data, np.int8, dim).astype(np.float32) * scale
+    if fmt == "binary":
+        return np.unpackbits(np.frombuffer(data, np.uint8), count=dim)
+    raise ValueError(f"Unknown embedding format: {fmt}")
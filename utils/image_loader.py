@@ -1,39 +1,343 @@
+import asyncio
+import contextvars
+import hashlib
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from threading import Lock
-
+import aiohttp
 import requests
 from PIL import Image
-from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+
+from utils import deadlines
+from utils.cache import SingleFlight, SizedCache
+from utils.log import get_logger
+from utils.metrics import stage, watch_cache, watch_counter
+
+logger = get_logger("image_loader")
+
+request_timeout = 10
+chunk_size = 64 * 1024
+header_probe_bytes = 1024 * 1024
+max_image_bytes = int(os.getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+max_image_pixels = int(os.getenv("IMAGE_MAX_PIXELS", str(64 * 1000 * 1000)))
+http_pool_hosts = int(os.getenv("HTTP_POOL_HOSTS", "16"))
+http_pool_per_host = int(os.getenv("HTTP_POOL_PER_HOST", "32"))
+
+
+class ImageTooLargeError(ValueError):
+    pass
+
+
+class _BodyReader:
+    """边下载边累积响应体：超过字节上限、或者文件头显示像素数过大时立刻中止下载"""
+
+    def __init__(self, url: str, content_length=None):
+        self.url = url
+        self.buffer = BytesIO()
+        self.header_checked = False
+        if content_length and int(content_length) > max_image_bytes:
+            raise ImageTooLargeError(f"{url}: body is {content_length} bytes, limit is {max_image_bytes}")
+
+    def feed(self, chunk: bytes):
+        self.buffer.write(chunk)
+        if self.buffer.tell() > max_image_bytes:
+            raise ImageTooLargeError(f"{self.url}: body exceeds {max_image_bytes} bytes")
+        if not self.header_checked and self.buffer.tell() <= header_probe_bytes:
+            self._check_header()
+
+    def _check_header(self):
+        # 只需要文件头就能拿到尺寸，解析失败说明数据还不够，等下一个分块
+        try:
+            width, height = Image.open(BytesIO(self.buffer.getvalue())).size
+        except Image.DecompressionBombError as e:
+            raise ImageTooLargeError(f"{self.url}: {e}") from e
+        except (OSError, SyntaxError, EOFError, struct.error):
+            return
+        self.header_checked = True
+        if width * height > max_image_pixels:
+            raise ImageTooLargeError(f"{self.url}: {width}x{height} exceeds {max_image_pixels} pixels")
+
+    def getvalue(self) -> bytes:
+        return self.buffer.getvalue()
+
+
+# 所有线程共享同一个连接池（HTTPAdapter 线程安全），Session 本身按线程隔离
+_http_adapter = HTTPAdapter(pool_connections=http_pool_hosts, pool_maxsize=http_pool_per_host)
+_thread_local = threading.local()
+
+
+def _get_session() -> requests.Session:
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.mount("http://", _http_adapter)
+        session.mount("https://", _http_adapter)
+        _thread_local.session = session
+    return session
+
+
+# 各模型真正需要的输入尺寸。三个模型的处理器都会再缩放一次，这里只需要便宜的滤镜：
+# CLIP 按短边 224 缩放后中心裁剪；OCR 和 VLM 沿用原来长边 768 的尺寸
+image_profiles = {
+    "clip": {"min_side": 224, "resample": Image.Resampling.BILINEAR},
+    "ocr": {"max_side": 768, "resample": Image.Resampling.BICUBIC},
+    "vlm": {"max_side": 768, "resample": Image.Resampling.BILINEAR},
+}
+
 
+def _target_size(size, profile: str):
+    spec = image_profiles[profile]
+    if "min_side" in spec:
+        ratio = spec["min_side"] / min(size)
+    else:
+        ratio = spec["max_side"] / max(size)
+    if ratio >= 1:
+        return None
+    return max(1, round(size[0] * ratio)), max(1, round(size[1] * ratio))
 
-def load_image_from_url(url: str):
+
+@stage("decode")
+def decode_image(data, profile: str = "vlm"):
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = BytesIO(data)
+    image = Image.open(data)
+
+    target = _target_size(image.size, profile)
+    if target is not None:
+        # JPEG 解码时直接按 1/2、1/4、1/8 缩小，大图不再全尺寸解码
+        image.draft("RGB", target)
+    image = image.convert("RGB")
+
+    target = _target_size(image.size, profile)
+    if target is not None:
+        # reducing_gap 让 Pillow 先做整数倍 reduce，再用便宜的滤镜缩放剩下的部分
+        image = image.resize(target, image_profiles[profile]["resample"], reducing_gap=2.0)
+    return image
+
+
+@stage("download")
+def fetch_image_bytes(url: str) -> bytes:
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content)).convert("RGB")
-        max_side = 768
-        if max(image.size) > max_side:
-            ratio = max_side / max(image.size)
-            new_size = (int(image.width * ratio), int(image.height * ratio))
-            image = image.resize(new_size, Image.Resampling.LANCZOS)
+        with _get_session().get(url, timeout=request_timeout, stream=True) as response:
+            response.raise_for_status()
+            reader = _BodyReader(url, response.headers.get("Content-Length"))
+            for chunk in response.iter_content(chunk_size):
+                reader.feed(chunk)
+        return reader.getvalue()
+    except Exception as e:
+        logger.warning("image download failed", url=url, error=e)
+        raise e
+
+
+def load_image_from_url(url: str, profile: str = "vlm"):
+    return decode_image(fetch_image_bytes(url), profile)
+
+
+# 三层缓存：原始字节按 URL 缓存，供不同尺寸的解码复用；解码结果按 (URL, 尺寸) 缓存；
+# 各模型处理器的输出按 (URL, 模型) 缓存，同一张图依次调用多个接口时跳过下载、解码和预处理。
+# 预算按字节计算，而不是条目数
+cache_ttl = float(os.getenv("IMAGE_CACHE_TTL", "180"))
+cache_policy = os.getenv("IMAGE_CACHE_POLICY", "ttl")
+bytes_cache = SizedCache("bytes", int(os.getenv("IMAGE_BYTES_CACHE_MB", "128")) << 20, cache_ttl, cache_policy)
+image_cache = SizedCache("decoded", int(os.getenv("IMAGE_DECODED_CACHE_MB", "128")) << 20, cache_ttl, cache_policy)
+preprocessed_cache = SizedCache("preprocessed", int(os.getenv("IMAGE_PREPROCESSED_CACHE_MB", "256")) << 20,
+                                cache_ttl, cache_policy)
+# 原始字节的内容摘要，下载时顺带算好；与字节缓存同样的过期策略，字节被挤出后查摘要不必重新下载
+digest_cache = SizedCache("digests", int(os.getenv("IMAGE_DIGEST_CACHE_MB", "4")) << 20, cache_ttl, cache_policy)
+# 同一个 URL 的并发未命中只下载 / 解码 / 预处理一次
+single_flight = SingleFlight()
+for _cache in (bytes_cache, image_cache, preprocessed_cache, digest_cache):
+    watch_cache(_cache.name, _cache.stats)
+watch_counter("vision_single_flight_deduplicated", "Cache misses that joined an in-flight load instead of starting one",
+              lambda: single_flight.deduplicated)
+
+
+def content_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _remember(url: str, data: bytes):
+    # 摘要总是和刚下载的字节一起更新，不会出现字节已换成新内容、摘要还是旧内容的情况
+    bytes_cache.put(url, data)
+    digest_cache.put(url, content_digest(data))
+
+
+def _download(url: str) -> bytes:
+    data = bytes_cache.peek(url)
+    if data is None:
+        logger.debug("downloading", url=url, sampled=True)
+        data = fetch_image_bytes(url)
+        _remember(url, data)
+    return data
+
+
+def get_image_bytes(url: str) -> bytes:
+    data = bytes_cache.get(url)
+    if data is not None:
+        return data
+    # 截止时间在合并之前检查：合并后的异常会传给同一 URL 的所有等待者
+    deadlines.check("download")
+    return single_flight.do(("bytes", url), lambda: _download(url))
+
+
+def get_image_digest(url: str) -> bytes:
+    """图片内容的摘要（content_digest），用于按内容寻址"""
+    digest = digest_cache.get(url)
+    if digest is None:
+        digest = content_digest(get_image_bytes(url))
+        digest_cache.put(url, digest)
+    return digest
+
+
+def _decode(url: str, profile: str):
+    key = (url, profile)
+    image = image_cache.peek(key)
+    if image is None:
+        image = decode_image(get_image_bytes(url), profile)
+        image_cache.put(key, image)
+    return image
+
+
+def get_image_smart(url: str, profile: str = "vlm"):
+    # 调用方已经拿到解码后的图片（例如异步预取）时直接使用
+    if isinstance(url, Image.Image):
+        return url
+
+    image = image_cache.get((url, profile))
+    if image is not None:
+        logger.debug("decoded cache hit", url=url, sampled=True)
         return image
+    deadlines.check("download")
+    return single_flight.do(("decoded", url, profile), lambda: _decode(url, profile))
+
+
+def get_preprocessed(image_input, model: str, profile: str, preprocess, image=None):
+    """
+    返回 preprocess(图片) 的结果，按 (URL, 模型) 缓存。
+    image 是调用方已经解码好的图片（例如异步预取的结果），未命中时直接用它，省掉一次缓存查找。
+    """
+    if isinstance(image_input, Image.Image):
+        deadlines.check("preprocess")
+        with stage("preprocess", model):
+            return preprocess(image_input)
+
+    key = (image_input, model)
+    value = preprocessed_cache.get(key)
+    if value is not None:
+        logger.debug("preprocessed cache hit", model=model, url=image_input, sampled=True)
+        return value
+    deadlines.check("preprocess")
+
+    def load():
+        result = preprocessed_cache.peek(key)
+        if result is None:
+            source = image if image is not None else get_image_smart(image_input, profile)
+            with stage("preprocess", model):
+                result = preprocess(source)
+            preprocessed_cache.put(key, result)
+        return result
+
+    return single_flight.do(("preprocessed",) + key, load)
+
+
+download_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="image-download")
+
+
+def map_concurrent(fn, *iterables) -> list:
+    """在下载线程池里并发执行 fn，返回与输入等长的列表，失败（或输入本身就是异常）的位置放异常对象"""
+    def call(*args):
+        for arg in args:
+            if isinstance(arg, Exception):
+                raise arg
+        return fn(*args)
+
+    # 每个任务带上调用方上下文的副本，下载线程里才能看到请求的截止时间和优先级
+    futures = [download_executor.submit(contextvars.copy_context().run, call, *args) for args in zip(*iterables)]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+# --- asyncio 版本：供 grpc.aio 服务端使用，下载不占线程，解码交给线程池 ---
+
+decode_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="image-decode")
+_http_session = None
+
+
+def _get_http_session():
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(limit=http_pool_hosts * http_pool_per_host,
+                                         limit_per_host=http_pool_per_host, ttl_dns_cache=300)
+        _http_session = aiohttp.ClientSession(connector=connector,
+                                              timeout=aiohttp.ClientTimeout(total=request_timeout))
+    return _http_session
+
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+
+async def fetch_image_bytes_async(url: str) -> bytes:
+    try:
+        with stage("download"):
+            async with _get_http_session().get(url) as response:
+                response.raise_for_status()
+                reader = _BodyReader(url, response.headers.get("Content-Length"))
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    reader.feed(chunk)
+            return reader.getvalue()
     except Exception as e:
-        print(f"❌ Failed to load image from {url}: {e}")
+        logger.warning("image download failed", url=url, error=e)
         raise e
 
 
-image_cache = TTLCache(maxsize=100, ttl=60*3)
-cache_lock = Lock()
+async def _download_async(url: str) -> bytes:
+    data = bytes_cache.peek(url)
+    if data is None:
+        logger.debug("downloading", url=url, sampled=True)
+        data = await fetch_image_bytes_async(url)
+        _remember(url, data)
+    return data
 
-def get_image_smart(url: str):
-    with cache_lock:
-        if url in image_cache:
-            print(f"⚡️ Cache Hit: {url}")
-            return image_cache[url]
 
-    print(f"🌐 Downloading: {url}")
-    image = load_image_from_url(url)
+async def get_image_bytes_async(url: str) -> bytes:
+    data = bytes_cache.get(url)
+    if data is not None:
+        return data
+    deadlines.check("download")
+    return await single_flight.do_async(("bytes", url), lambda: _download_async(url))
 
-    with cache_lock:
-        image_cache[url] = image
+
+async def _decode_async(url: str, profile: str):
+    key = (url, profile)
+    image = image_cache.peek(key)
+    if image is None:
+        data = await get_image_bytes_async(url)
+        image = await asyncio.get_running_loop().run_in_executor(decode_executor, decode_image, data, profile)
+        image_cache.put(key, image)
     return image
+
+
+async def get_image_smart_async(url: str, profile: str = "vlm"):
+    image = image_cache.get((url, profile))
+    if image is not None:
+        logger.debug("decoded cache hit", url=url, sampled=True)
+        return image
+    deadlines.check("download")
+    return await single_flight.do_async(("decoded", url, profile), lambda: _decode_async(url, profile))
+
+
+async def get_images_smart_async(urls: list[str], profile: str = "vlm") -> list:
+    """并发下载多张图片，返回与 urls 等长的列表，下载失败的位置放异常对象"""
+    return await asyncio.gather(*(get_image_smart_async(url, profile) for url in urls), return_exceptions=True)
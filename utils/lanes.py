@@ -0,0 +1,109 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from utils import deadlines
+
+
+class LaneFullError(Exception):
+    pass
+
+
+class Lane:
+    """
+    单个模型家族的执行通道：固定数量的工作线程 + 有界等待队列。
+    队列满时 submit 直接抛 LaneFullError，由调用方快速拒绝请求，而不是无限排队。
+    - 优先级：每个优先级一个队列，空闲线程总是先取优先级最高的任务；
+      队列满时高优先级请求会挤掉最晚进入的更低优先级任务（以 LaneFullError 结束），而不是自己被拒绝
+    - 截止时间：任务带上提交时请求的截止时间，出队时已经过期的任务不再执行，直接以 DeadlineExceededError 结束
+    - 任务在提交方的 contextvars 上下文里执行，截止时间和优先级对任务内部的各阶段可见
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.in_flight = 0
+        # 出队时已经过期而被丢弃、以及被高优先级任务挤掉的任务数
+        self.expired = 0
+        self.shed = 0
+
+        self._queues = {p: deque() for p in sorted(deadlines.priority_names.values())}
+        self._cond = threading.Condition()
+        for i in range(self.max_concurrency):
+            threading.Thread(target=self._worker, name=f"lane-{name}-{i}", daemon=True).start()
+
+    @property
+    def capacity(self) -> int:
+        return self.max_concurrency + self.max_queue
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _evict_lower(self, priority: int) -> bool:
+        for lower in sorted(self._queues, reverse=True):
+            if lower <= priority:
+                return False
+            if self._queues[lower]:
+                future = self._queues[lower].pop()[0]
+                self.shed += 1
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(LaneFullError(f"{self.name} lane shed lower-priority work"))
+                return True
+        return False
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        priority = deadlines.priority()
+        task = (future, fn, args, kwargs, contextvars.copy_context(), deadlines.deadline())
+        with self._cond:
+            queued = self.queued
+            # 有空闲线程时不计入排队长度
+            idle = self.max_concurrency - self.in_flight - queued
+            if idle <= 0 and queued >= self.max_queue and not self._evict_lower(priority):
+                raise LaneFullError(f"{self.name} lane is saturated "
+                                    f"({self.in_flight} running, {queued} queued)")
+            self._queues[priority].append(task)
+            self._cond.notify()
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _pop(self):
+        for queue in self._queues.values():
+            if queue:
+                return queue.popleft()
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                task = self._pop()
+                while task is None:
+                    self._cond.wait()
+                    task = self._pop()
+                future, fn, args, kwargs, context, deadline = task
+                expired = deadline is not None and time.monotonic() >= deadline
+                if expired:
+                    self.expired += 1
+                else:
+                    self.in_flight += 1
+
+            if expired:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(deadlines.DeadlineExceededError(f"deadline exceeded in {self.name} queue"))
+                continue
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(context.run(fn, *args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    self.in_flight -= 1
@@ -0,0 +1,90 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+# text：人读的 key=value；json：每行一个 JSON 对象，方便日志系统解析
+log_format = os.getenv("LOG_FORMAT", "text")
+# 每个请求都会打的热路径日志（sampled=True）按这个比例采样；WARNING 及以上不采样
+log_sample_rate = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+_reserved = ("exc_info", "stack_info", "stacklevel", "extra")
+
+
+class _SampleFilter(logging.Filter):
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not getattr(record, "sampled", False):
+            return True
+        return random.random() < log_sample_rate
+
+
+class _Formatter(logging.Formatter):
+    def format(self, record):
+        fields = getattr(record, "fields", {})
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+        if log_format == "json":
+            entry = {"ts": f"{timestamp}.{int(record.msecs):03d}", "level": record.levelname,
+                     "logger": record.name, "msg": record.getMessage(), **fields}
+            if record.exc_info:
+                entry["exc"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+
+        line = f"{timestamp} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # 同进程队列不需要序列化：只提前渲染消息，异常信息原样留给后台线程格式化
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """
+    logger.info("request", rpc="EmbedText", url=url, sampled=True)：
+    关键字参数作为结构化字段输出，sampled=True 的记录参与采样。
+    """
+
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in _reserved}
+        sampled = bool(fields.pop("sampled", False))
+        kwargs["extra"] = {**kwargs.get("extra", {}), "fields": fields, "sampled": sampled}
+        return msg, kwargs
+
+
+def _configure():
+    # 格式化和写 stderr 都在后台线程里做，请求线程只把记录放进队列
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(_Formatter())
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    queue_handler = _QueueHandler(records)
+    queue_handler.addFilter(_SampleFilter())
+    root = logging.getLogger("vision")
+    root.setLevel(log_level)
+    root.addHandler(queue_handler)
+    root.propagate = False
+
+
+_configure()
+
+
+def get_logger(name: str) -> StructuredLogger:
+    return StructuredLogger(logging.getLogger(f"vision.{name}"), {})
@@ -0,0 +1,125 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+
+from utils.log import get_logger
+
+logger = get_logger("metrics")
+
+# METRICS_PORT=0 时不启动 /metrics；默认端口避开 node_exporter 等常见 exporter 占用的 9100-9999
+metrics_port = int(os.getenv("METRICS_PORT", "19100"))
+metrics_addr = os.getenv("METRICS_ADDR", "0.0.0.0")
+
+_latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+rpc_requests = Counter("vision_rpc_requests_total", "RPCs received", ["rpc"])
+rpc_errors = Counter("vision_rpc_errors_total", "RPCs finished with a non-OK status", ["rpc", "code"])
+rpc_latency = Histogram("vision_rpc_latency_seconds", "End-to-end RPC latency", ["rpc"], buckets=_latency_buckets)
+rpc_in_flight = Gauge("vision_rpc_in_flight", "RPCs currently being handled", ["rpc"])
+stage_latency = Histogram("vision_stage_latency_seconds", "Latency of one request stage",
+                          ["stage", "model"], buckets=_latency_buckets)
+lane_queued = Gauge("vision_lane_queued", "Requests waiting in a model lane", ["lane"])
+lane_in_flight = Gauge("vision_lane_in_flight", "Requests running in a model lane", ["lane"])
+# reason：expired 出队时已过截止时间，shed 被高优先级请求挤出队列
+lane_dropped = Gauge("vision_lane_dropped", "Queued requests dropped by a model lane", ["lane", "reason"])
+rpc_rejected = Counter("vision_rpc_rejected_total", "RPCs rejected by per-RPC admission limits", ["rpc"])
+# OCR 文字预筛：result 取 passed / skipped / audited / false_negative，
+# 跳过率 = skipped / (passed + skipped)，漏检率 = false_negative / audited
+ocr_prefilter = Counter("vision_ocr_prefilter_total", "Text-presence pre-filter decisions", ["result"])
+# 微批处理：每个批次的大小，以及批次里每条请求从入队到发车的等待时间，用来调 EMBED_MAX_BATCH_SIZE / EMBED_MAX_WAIT_MS
+batch_size = Histogram("vision_batch_size", "Items per micro-batch", ["batcher"],
+                       buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+batch_queue_wait = Histogram("vision_batch_queue_wait_seconds", "Time an item waited for its micro-batch", ["batcher"],
+                             buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+ocr_text_score = Histogram("vision_ocr_text_score", "Text-presence score of images sent to OCR",
+                           buckets=(0.001, 0.0025, 0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 1))
+
+
+@contextmanager
+def stage(name: str, model: str = "image"):
+    """记录一个处理阶段的耗时：download / decode / preprocess / forward / postprocess，也可以当装饰器用"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_latency.labels(name, model).observe(time.perf_counter() - start)
+
+
+def watch_lane(lane):
+    lane_queued.labels(lane.name).set_function(lambda: lane.queued)
+    lane_in_flight.labels(lane.name).set_function(lambda: lane.in_flight)
+    lane_dropped.labels(lane.name, "expired").set_function(lambda: lane.expired)
+    lane_dropped.labels(lane.name, "shed").set_function(lambda: lane.shed)
+
+
+class _FunctionCollector:
+    """抓取时才调用 fn() 取值，热路径上的对象只需要维护一个数；fn 返回 None 时这一项不输出"""
+
+    def __init__(self, family, name: str, documentation: str, fn):
+        self.family = family
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+
+    def collect(self):
+        value = self.fn()
+        if value is not None:
+            yield self.family(self.name, self.documentation, value=value)
+
+
+def watch_gauge(name: str, documentation: str, fn):
+    REGISTRY.register(_FunctionCollector(GaugeMetricFamily, name, documentation, fn))
+
+
+def watch_counter(name: str, documentation: str, fn):
+    REGISTRY.register(_FunctionCollector(CounterMetricFamily, name, documentation, fn))
+
+
+class _CacheCollector:
+    """
+    缓存命中率在抓取时从各缓存的 stats() 读出，热路径上不额外计数。
+    stats() 需要包含 hits / misses，可选 entries / bytes / evictions。
+    """
+
+    def __init__(self):
+        self.sources = {}
+
+    def collect(self):
+        requests = CounterMetricFamily("vision_cache_requests", "Cache lookups", labels=["cache", "result"])
+        evictions = CounterMetricFamily("vision_cache_evictions", "Cache evictions", labels=["cache"])
+        entries = GaugeMetricFamily("vision_cache_entries", "Cached entries", labels=["cache"])
+        size = GaugeMetricFamily("vision_cache_bytes", "Cached bytes", labels=["cache"])
+        for name, stats_fn in list(self.sources.items()):
+            stats = stats_fn()
+            requests.add_metric([name, "hit"], stats["hits"])
+            requests.add_metric([name, "miss"], stats["misses"])
+            if "evictions" in stats:
+                evictions.add_metric([name], stats["evictions"])
+            if "entries" in stats:
+                entries.add_metric([name], stats["entries"])
+            if "bytes" in stats:
+                size.add_metric([name], stats["bytes"])
+        yield from (requests, evictions, entries, size)
+
+
+_cache_collector = _CacheCollector()
+REGISTRY.register(_cache_collector)
+
+
+def watch_cache(name: str, stats_fn):
+    _cache_collector.sources[name] = stats_fn
+
+
+def start_metrics_server():
+    if not metrics_port:
+        return
+    # 端口被占用只影响指标抓取，不应该让推理服务起不来
+    try:
+        start_http_server(metrics_port, metrics_addr)
+    except OSError as e:
+        logger.error("metrics server failed to start", addr=metrics_addr, port=metrics_port, error=e)
+        return
+    logger.info("metrics server started", addr=metrics_addr, port=metrics_port)